@@ -1,4 +1,4 @@
-#!/usr/bin/python3.6
+#!/usr/bin/python3.7
 
 """Launcher script for the PythonSCA GUI.
 
@@ -17,20 +17,18 @@ SCA² (C) 2012 Mark Rosenfelder aka Zompist (markrose@zompist.com)
 Python re-code (C) 2015 Andreas Kübrich aka Schyrsivochter (andreas.kuebrich@kuebrich.de)"""
 
 
-import re, sys
-
-gdebug = False
+import os, re, sys, io, time, argparse, hashlib
+import collections, itertools, threading, concurrent.futures, pickle, marshal, tempfile
+try:
+    from re import _parser as sre_parse
+except ImportError: # Python < 3.11
+    import sre_parse
+numpy = None # the batch engine is optional and imports it on first use, see importNumpy
 
 class SCAError(Exception):
     "Error class for everything SCA-related (e.g. invalid rules or categories)"
     pass
 
-def printDebug(funcName, *args):
-    if gdebug:
-        print(f"\nDebug info from {funcName}:", file=sys.stderr)
-        for name, value in args:
-            print(f"{name} = {value!r}", file=sys.stderr)
-
 def ruleExToRegex(expression, categories, numGroups):
     """Transform a part of a sound change rule into a regular expression.
 
@@ -47,7 +45,6 @@ are used for degemination."""
     brackets = False
     lastWasBracket = False
     for char in expression:
-        oldchar = char
         if   char == "#":
             char = " "
         elif char == "[":
@@ -78,9 +75,104 @@ are used for degemination."""
             pass
         regExpression += (char + "|") if (brackets and not lastWasBracket) else char
         lastWasBracket = False
-        printDebug("ruleExToRegex", ("regExpression", regExpression), ("oldchar", oldchar), ("char", char), ("numGroups", numGroups))
     return regExpression, numGroups
 
+def maxMatchLength(regExpression):
+    """Return the maximum length of any match of a regular expression.
+
+Arguments:
+    regExpression : string
+Returns an integer, or sys.maxsize if the length is unbounded or unknown."""
+
+    def width(pattern, groups):
+        total = 0
+        for op, av in pattern:
+            if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN):
+                w = 1
+            elif op is sre_parse.SUBPATTERN:
+                group, subpattern = av[0], av[-1]
+                w = width(subpattern, groups)
+                if group:
+                    groups[group] = w
+            elif op is sre_parse.BRANCH:
+                w = max(width(branch, groups) for branch in av[1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                minRep, maxRep, subpattern = av
+                if maxRep == sre_parse.MAXREPEAT:
+                    return sys.maxsize
+                w = maxRep * width(subpattern, groups)
+            elif op is sre_parse.GROUPREF:
+                w = groups.get(av, sys.maxsize)
+            elif op is sre_parse.AT:
+                w = 0
+            else:
+                return sys.maxsize
+            total = min(total + w, sys.maxsize)
+        return total
+
+    try:
+        return width(sre_parse.parse(regExpression), {})
+    except re.error:
+        return sys.maxsize
+
+def minMatchLength(regExpression):
+    """Return the minimum length of any match of a regular expression.
+
+Arguments:
+    regExpression : string
+Returns an integer, 0 if the expression is invalid."""
+
+    try:
+        return sre_parse.parse(regExpression).getwidth()[0]
+    except re.error:
+        return 0
+
+def requiredChars(regExpression):
+    """Find sets of characters of which any match of a regular expression
+must contain at least one each.
+
+Arguments:
+    regExpression : string
+Returns a list of frozensets, smallest first. The list may be incomplete
+(and is empty if nothing is known), but never wrong."""
+
+    def charSet(av):
+        chars = set()
+        for op, value in av:
+            if op is sre_parse.LITERAL:
+                chars.add(chr(value))
+            elif op is sre_parse.RANGE and value[1] - value[0] < 256:
+                chars.update(map(chr, range(value[0], value[1] + 1)))
+            else: # negated sets, character classes or large ranges
+                return None
+        return frozenset(chars)
+
+    def required(pattern):
+        sets = []
+        for op, av in pattern:
+            if op is sre_parse.LITERAL:
+                sets.append(frozenset(chr(av)))
+            elif op is sre_parse.IN:
+                chars = charSet(av)
+                if chars is not None:
+                    sets.append(chars)
+            elif op is sre_parse.SUBPATTERN:
+                sets += required(av[-1])
+            elif op is sre_parse.BRANCH:
+                # each alternative has to contribute one of its characters
+                alternatives = [required(branch) for branch in av[1]]
+                if all(alternatives):
+                    sets.append(frozenset().union(*(alt[0] for alt in alternatives)))
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] > 0:
+                sets += required(av[2])
+        return sets
+
+    try:
+        sets = required(sre_parse.parse(regExpression))
+    except re.error:
+        return []
+    return sorted(set(sets), key=len)
+
 def ruleToRegex(target, environment, categories):
     """Transform a sound change rule into a set of regular expressions.
 
@@ -100,9 +192,49 @@ Returns a tuple (wholeRE, beforeRE, targetRE, afterRE)."""
     tgtRE, numGroups = ruleExToRegex(target, categories, numGroups)
     tgtRE = f"({tgtRE})"
     aftRE, numGroups = ruleExToRegex(envAfter, categories, numGroups)
-    printDebug("ruleToRegex",("target", target), ("environment", environment), ("envBefore", envBefore), ("envAfter", envAfter), ("result", (befRE + tgtRE + aftRE, befRE, tgtRE, aftRE)))
     return befRE + tgtRE + aftRE, befRE, tgtRE, aftRE, tgtIndex
 
+def ruleExToSets(expression, categories):
+    """Transform a part of a sound change rule into a list of character sets,
+one for each character a match consists of.
+
+Arguments:
+    expression : string
+    categories : dict {"A": "abc", ...}
+Returns a list of frozensets, or None if the expression can match strings
+of different lengths (optional parts) or contains a gemination (\u00b2)."""
+
+    sets = []
+    bracket = None # the characters of the brackets we are in
+    for char in expression:
+        if char == "[":
+            if bracket is not None:
+                return None
+            bracket = set()
+            continue
+        if char == "]":
+            if not bracket:
+                return None
+            sets.append(frozenset(bracket))
+            bracket = None
+            continue
+        if char in "()\u00b2":
+            return None
+        if char == "#":
+            chars = {" "}
+        elif char in categories:
+            catContent = categories[char]
+            if not catContent or not set(catContent).isdisjoint("[]^-\\"): # not just characters in the regex
+                return None
+            chars = set(catContent)
+        else:
+            chars = {char}
+        if bracket is not None:
+            bracket |= chars
+        else:
+            sets.append(frozenset(chars))
+    return None if bracket is not None else sets
+
 def replace(tgtword, rule, categories):
     target, replacement, envDummy, excDummy = rule
     if replacement == "\\\\": # metathesis
@@ -120,10 +252,439 @@ def replace(tgtword, rule, categories):
             repCat = categories[char]
             char = "" if len(repCat) <= tgtIdx else repCat[tgtIdx]
         if char == "\u00b2": # gemination
+            if not replacestr:
+                raise SCAError('Bad sound change rule: "' + "/".join(rule if rule[3] else rule[0:3]) + f'" (gemination \u00b2 has nothing to double for "{tgtword}")')
             char = replacestr[-1] # last character
         replacestr += char
     return replacestr
 
+generatedCode = {} # {rule fingerprint: (source, code object)}, see CompiledRule.generated
+
+class CompiledRule:
+    """A single sound change rule, checked and compiled into regular
+expressions once so that it can be applied to any number of words.
+
+Arguments:
+    rule       : tuple (target, replacement, environment, exception)
+    categories : dict {"A": "abc", ...}
+
+Exception may be an empty string. Raises SCAError if the environment or
+the exception does not contain exactly one underscore, if the replacement
+begins with a gemination (\u00b2) that has nothing to double, or if the rule
+or its categories do not make valid regular expressions (e.g. an
+unbalanced parenthesis or bracket)."""
+
+    def __init__(self, rule, categories):
+        target, replacement, environment, exception = rule
+        self.rule = rule
+        self.categories = categories
+        try:
+            envmtRE, envBefRE, tgtRE, envAftRE, self.tgtIndex = ruleToRegex(target, environment, categories)
+        except SCAError as e:
+            raise SCAError('Bad sound change rule: "' + "/".join(rule if exception else rule[0:3]) + '" (environment must contain exactly one underscore)') from e
+        if target and replacement.startswith("\u00b2"): # epenthesis inserts the replacement as it is
+            raise SCAError('Bad sound change rule: "' + "/".join(rule if exception else rule[0:3]) + '" (gemination \u00b2 must follow the character it doubles)')
+        self.envRE = self.compileRE(envmtRE, "environment")
+        # how far a match can reach before the target and in total
+        self.befWidth = maxMatchLength(envBefRE)
+        self.envWidth = maxMatchLength(envmtRE)
+        if exception:
+            try:
+                excptRE, excBefRE, dummy, excAftRE, self.etgtIndex = ruleToRegex(target, exception, categories)
+            except SCAError as e:
+                raise SCAError('Bad sound change rule: "' + "/".join(rule) + '" (exception must contain exactly one underscore)') from e
+            self.excRE = self.compileRE(excptRE, "exception")
+            self.excBefWidth = maxMatchLength(excBefRE)
+            self.excWidth = maxMatchLength(excptRE)
+        else:
+            self.excRE = None
+            self.etgtIndex = None
+            self.excBefWidth = self.excWidth = 0
+        # if rule is epenthesis where nothing has to come before, such as "/x/_a" or "/x/(C)_a"
+        self.isEpen = not target and minMatchLength(envBefRE) == 0
+        # a word needs one character of each of these for the rule to match
+        self.required = requiredChars(envmtRE)
+        self.charMap = self.simpleCharMap()
+        self.fastApply = None # used instead of apply() if set, see CompiledRuleSet.setEngine
+
+    def compileRE(self, regExpression, part):
+        "Compile a regular expression made from a part of the rule; raise SCAError if it is invalid."
+        try:
+            return re.compile(regExpression)
+        except re.error as e:
+            rule = self.rule
+            raise SCAError('Bad sound change rule: "' + "/".join(rule if rule[3] else rule[0:3]) + f'" ({part}: {e})') from e
+
+    def simpleCharMap(self):
+        """Return a dict {character: replacement character} if the rule does
+nothing but replace single characters by single characters, wherever
+they are: its environment is "_", it has no exception, and its target
+and its replacement are a character or a category each. Such a rule
+gives the same result as str.translate() with the dict on all but the
+first character of a word, which rules never change (it is the space
+for the word boundary in padded words). Otherwise, return None."""
+
+        target, replacement, environment, exception = self.rule
+        if environment != "_" or exception or len(target) != 1 or len(replacement) != 1:
+            return None
+        if target in "#[]()_/\\ \u00b2" or replacement in "\u00b2":
+            return None
+        if target not in self.categories:
+            return {target: replacement}
+        tgtCat = self.categories[target]
+        if not set(tgtCat).isdisjoint("[]^-\\ "): # not just characters in the regex
+            return None
+        if replacement not in self.categories:
+            return {char: replacement for char in tgtCat}
+        repCat = self.categories[replacement]
+        charMap = {}
+        for char in tgtCat:
+            tgtIdx = tgtCat.find(char)
+            if tgtIdx >= len(repCat): # deletes, which skips the next character
+                return None
+            charMap[char] = repCat[tgtIdx]
+        return charMap
+
+    def transducer(self, maxStates=4096):
+        """Compile the rule into a RuleTransducer.
+
+Arguments:
+    maxStates : largest number of states the transducer may have.
+        Defaults to 4096.
+Returns a RuleTransducer, or None if the rule can match strings of
+different lengths, contains a gemination (\u00b2) or needs too many states."""
+
+        target, replacement, environment, exception = self.rule
+        if "\u00b2" in replacement:
+            return None
+        envBefore, envAfter = environment.split("_")
+        parts = [ruleExToSets(part, self.categories) for part in (envBefore, target, envAfter)]
+        if exception:
+            excBefore, excAfter = exception.split("_")
+            parts += [ruleExToSets(part, self.categories) for part in (excBefore, excAfter)]
+            if None not in parts and not (parts[3] or parts[1] or parts[4]):
+                return None # an empty exception matches differently at the end of the word
+        if None in parts:
+            return None
+        fst = RuleTransducer(self, *parts[:3], parts[3:] or None)
+        return fst if len(fst.accepting) <= maxStates else None
+
+    def fingerprint(self):
+        "Return a hash of the rule and of the categories it uses."
+        used = sorted((key, cat) for key, cat in self.categories.items() if any(key in part for part in self.rule))
+        return hashlib.sha1(repr((self.rule, used)).encode("utf8")).hexdigest()
+
+    def source(self):
+        """Generate the source code of a function apply(word, counts=None)
+that does the same as apply(), specialized for this rule: the regular
+expressions and widths are constants, the matching is inlined, the code
+for exceptions is only there if the rule has one, and the replacement is
+precomputed: a constant string, the reversed target for metathesis, or a
+dict {first character of the target: replacement} for category
+replacements, with any gemination (\u00b2) already done.
+
+Returns a string with the source code of a module."""
+
+        target, replacement, environment, exception = self.rule
+        befWidth, envWidth = self.befWidth, self.envWidth
+        keep = max(befWidth, self.excBefWidth)
+        # everything taken from the rule goes into the code through repr()
+        lines = [
+            f"envRE = re.compile({self.envRE.pattern!r})",
+        ]
+        if self.excRE:
+            lines.append(f"excRE = re.compile({self.excRE.pattern!r})")
+        # the replacement depends on nothing but the first character of the target
+        if replacement == "\\\\":
+            repCode = ["repword = tgtWord[::-1]"]
+        elif not target:
+            repCode = [f"repword = {replacement!r}"]
+        else:
+            try:
+                if target[0] in self.categories:
+                    reps = {char: replace(char, self.rule, self.categories) for char in self.categories[target[0]]}
+                    lines.append(f"REPS = {reps!r}")
+                    repCode = ["repword = REPS.get(tgtWord[0])", "if repword is None:", "    repword = replace(tgtWord, RULE, CATEGORIES)"]
+                else:
+                    repCode = [f"repword = {replace(target, self.rule, self.categories)!r}"]
+            except SCAError: # gemination after a category with no character for the target, which fails on those
+                repCode = ["repword = replace(tgtWord, RULE, CATEGORIES)"]
+        if "RULE" in repCode[-1]:
+            lines.append(f"RULE = {self.rule!r}")
+            lines.append(f"CATEGORIES = {self.categories!r}")
+        lines += [
+            "",
+            "def apply(word, counts=None):",
+            "    out = []",
+            "    done = 0",
+            "    tail = ''",
+            "    src = word",
+            "    j = 0",
+            "    length = len(word)",
+            "    search, match = envRE.search, envRE.match",
+            "    tgtpos = 1",
+            "    startpos = 0",
+            "    nextMatch = None",
+            "    excTargets = None",
+            "    matches = exceptions = 0",
+            "    while startpos < length:",
+            "        lastpos = min(tgtpos, length - 1)",
+            f"        pos = max(startpos, tgtpos - {befWidth})",
+            "        envMatch = None",
+            "        while pos <= lastpos:",
+            "            if pos >= done:",
+            "                srcpos = pos - done + j",
+            "                if nextMatch is None or not (nextMatch[0] <= srcpos and (nextMatch[1] is None or srcpos <= nextMatch[1])):",
+            "                    m = search(src, srcpos)",
+            "                    nextMatch = srcpos, (m.start() if m else None)",
+            "                if nextMatch[1] is None:",
+            "                    break",
+            "                pos = nextMatch[1] - j + done",
+            "                if pos > lastpos:",
+            "                    break",
+            "                m = match(src, pos - done + j)",
+            "                offset = done - j",
+            "            else:",
+            f"                m = match(tail[len(tail) - (done - pos):] + src[j:j + {envWidth}])",
+            "                offset = pos",
+            f"            if m and m.start({self.tgtIndex}) + offset == tgtpos:",
+            "                envMatch = m",
+            "                break",
+            "            pos += 1",
+            "        if envMatch is None:",
+            "            if tgtpos >= length:",
+            "                break",
+            "            tgtpos += 1",
+            "            startpos = 0",
+            f"            lo = tgtpos - {befWidth}",
+            "            if lo >= done and nextMatch is not None and nextMatch[0] <= lo - done + j:",
+            "                if nextMatch[1] is None:",
+            "                    break",
+            "                tgtpos = max(tgtpos, nextMatch[1] - j + done)",
+            "            continue",
+            "",
+            f"        tgtEnd = envMatch.end({self.tgtIndex}) + offset",
+            f"        tgtWord = envMatch.group({self.tgtIndex})",
+            "        matches += 1",
+        ]
+        if self.excRE:
+            lines += [
+                "        if excTargets is None:",
+                "            excTargets = {}",
+                "            excMatch = excRE.search(word)",
+                "            while excMatch and excMatch.start() < len(word):",
+                f"                excTargets[excMatch.start({self.etgtIndex})] = excMatch.start()",
+                "                excMatch = excRE.search(word, excMatch.start() + 1)",
+                "        excApplies = excTargets.get(tgtpos - done + j, -1) >= j",
+                f"        for expos in range(max(0, tgtpos - {self.excBefWidth}), min(done, tgtpos + 1)):",
+                "            if excApplies:",
+                "                break",
+                "            if expos >= done:",
+                "                excMatch, exOffset = excRE.match(src, expos - done + j), done - j",
+                "            else:",
+                f"                excMatch, exOffset = excRE.match(tail[len(tail) - (done - expos):] + src[j:j + {self.excWidth}]), expos",
+                f"            excApplies = bool(excMatch) and excMatch.start({self.etgtIndex}) + exOffset == tgtpos",
+                "        if excApplies:",
+                "            exceptions += 1",
+                "            repword = tgtWord",
+                "        else:",
+            ]
+            lines += ["            " + line for line in repCode]
+        else:
+            lines += ["        " + line for line in repCode]
+        lines += [
+            "        segment = src[j:j + tgtpos - done] + repword",
+            "        out.append(segment)",
+            f"        tail = (tail + segment)[-{keep}:]" if keep else None,
+            "        j += tgtEnd - done",
+            "        done = tgtpos + len(repword)",
+            "        length = done + len(src) - j",
+            "        nextMatch = None",
+            f"        tgtpos += len(repword){' + 1' if self.isEpen else ''}",
+            "        if tgtpos == pos:",
+            "            tgtpos += 1",
+            "            startpos = 0",
+            "        else:",
+            "            startpos = pos + 1",
+            "    if counts is not None:",
+            "        counts[0] += matches",
+            "        counts[1] += exceptions",
+            "    if not out:",
+            "        return word",
+            "    out.append(src[j:])",
+            "    return ''.join(out)",
+        ]
+        return "\n".join(line for line in lines if line is not None) + "\n"
+
+    def generated(self):
+        """Return the function whose code source() generates. The code is
+compiled once per fingerprint() and kept in generatedCode."""
+
+        fingerprint = self.fingerprint()
+        if fingerprint not in generatedCode:
+            source = self.source()
+            generatedCode[fingerprint] = source, compile(source, f"<rule {fingerprint[:12]}>", "exec")
+        namespace = {"re": re, "replace": replace}
+        exec(generatedCode[fingerprint][1], namespace)
+        return namespace["apply"]
+
+    def verified(self, func, name):
+        """Return a function that applies the rule with func, as in
+func(word, counts=None), and raises SCAError if the result differs
+from the one of apply()."""
+
+        ruleText = "/".join(self.rule if self.rule[3] else self.rule[:3])
+        def verifiedApply(word, counts=None):
+            result = func(word, counts)
+            expected = self.apply(word)
+            if result != expected:
+                raise SCAError(f'{name} of the rule "{ruleText}" gives "{result}" instead of "{expected}" for "{word}"')
+            return result
+        return verifiedApply
+
+    def __getstate__(self):
+        # fastApply may be a generated function, which cannot be pickled
+        state = self.__dict__.copy()
+        if not isinstance(self.fastApply, RuleTransducer):
+            state["fastApply"] = None
+        return state
+
+    def exceptionIndex(self, word):
+        """Find all places where the exception matches a word.
+
+Arguments:
+    word : string
+Returns a dict {target position: last position where an exception match
+with that target starts}."""
+
+        excRE, etgtIndex = self.excRE, self.etgtIndex
+        excTargets = {}
+        excMatch = excRE.search(word)
+        while excMatch and excMatch.start() < len(word):
+            excTargets[excMatch.start(etgtIndex)] = excMatch.start()
+            excMatch = excRE.search(word, excMatch.start() + 1)
+        return excTargets
+
+    def apply(self, word, counts=None):
+        """Apply the rule to a word.
+
+Arguments:
+    word   : string
+    counts : list [matches, exceptions] to add the number of environment
+        matches and of those the exception matched, too, to. Defaults to
+        None.
+Returns the output word.
+
+Each position of the word is a target position in turn, from left to
+right. For every target position, the environment is matched at every
+position up to it, and the first match whose target starts there is
+replaced. Since a match can begin at most befWidth characters before
+its target, only those positions are tried; the finished part of the
+output is collected in segments and never scanned again. Where the
+exception matches is looked up in an index built once per word."""
+
+        rule = self.rule
+        envRE, tgtIndex, befWidth, envWidth = self.envRE, self.tgtIndex, self.befWidth, self.envWidth
+        excRE, etgtIndex, excBefWidth, excWidth = self.excRE, self.etgtIndex, self.excBefWidth, self.excWidth
+        keep = max(befWidth, excBefWidth) # how much of the output may be looked back at
+
+        # the word is out + src[j:], where out holds the done characters
+        out = []
+        done = 0
+        tail = "" # the last keep characters of out
+        src = word
+        j = 0
+        length = len(word)
+
+        def matchAt(regex, width, pos):
+            "Match regex at pos; return the match and the offset of its string in the word."
+            if pos >= done:
+                return regex.match(src, pos - done + j), done - j
+            # part of the match may lie in the output, so match on a piece of the word
+            return regex.match(tail[len(tail) - (done - pos):] + src[j:j + width]), pos
+
+        # tgtpos is the position of the target, pos is the one of the environment
+        tgtpos = 1
+        startpos = 0
+        nextMatch = None # (from where, where) the environment matches next in src
+        excTargets = None # built on the first environment match
+        matches = exceptions = 0
+        while startpos < length:
+            lastpos = min(tgtpos, length - 1)
+            pos = max(startpos, tgtpos - befWidth)
+            envMatch = None
+            while pos <= lastpos:
+                if pos >= done:
+                    # skip ahead to where the environment can match at all
+                    srcpos = pos - done + j
+                    if nextMatch is None or not (nextMatch[0] <= srcpos and (nextMatch[1] is None or srcpos <= nextMatch[1])):
+                        m = envRE.search(src, srcpos)
+                        nextMatch = srcpos, (m.start() if m else None)
+                    if nextMatch[1] is None:
+                        break
+                    pos = nextMatch[1] - j + done
+                    if pos > lastpos:
+                        break
+                m, offset = matchAt(envRE, envWidth, pos)
+                if m and m.start(tgtIndex) + offset == tgtpos:
+                    envMatch = m
+                    break
+                pos += 1
+            if envMatch is None:
+                if tgtpos >= length:
+                    break
+                tgtpos += 1
+                startpos = 0
+                lo = tgtpos - befWidth
+                if lo >= done and nextMatch is not None and nextMatch[0] <= lo - done + j:
+                    # no target can be found before the next environment match
+                    if nextMatch[1] is None:
+                        break
+                    tgtpos = max(tgtpos, nextMatch[1] - j + done)
+                continue
+
+            tgtEnd = envMatch.end(tgtIndex) + offset
+            tgtWord = envMatch.group(tgtIndex) # the substring to replace
+            # find out about the exception, if there is one
+            excApplies = False
+            if excRE:
+                if excTargets is None:
+                    excTargets = self.exceptionIndex(word)
+                # exceptions lying wholly in src are looked up in the index
+                excApplies = excTargets.get(tgtpos - done + j, -1) >= j
+                # those starting in the output have to be matched again
+                for expos in range(max(0, tgtpos - excBefWidth), min(done, tgtpos + 1)):
+                    if excApplies:
+                        break
+                    excMatch, exOffset = matchAt(excRE, excWidth, expos)
+                    excApplies = bool(excMatch) and excMatch.start(etgtIndex) + exOffset == tgtpos # if they both match the same thing
+
+            matches += 1
+            if excApplies:
+                exceptions += 1
+            repword = tgtWord if excApplies else replace(tgtWord, rule, self.categories)
+            segment = src[j:j + tgtpos - done] + repword
+            out.append(segment)
+            tail = (tail + segment)[-keep:] if keep else ""
+            j += tgtEnd - done
+            done = tgtpos + len(repword)
+            length = done + len(src) - j
+            nextMatch = None
+            # move behind that which already has been processed
+            tgtpos += len(repword) + (1 if self.isEpen else 0) # add 1 on epenthesis before something – else we’ll get caught in an endless loop
+            if tgtpos == pos:
+                tgtpos += 1
+                startpos = 0
+            else:
+                startpos = pos + 1
+        if counts is not None:
+            counts[0] += matches
+            counts[1] += exceptions
+        if not out:
+            return word
+        out.append(src[j:])
+        return "".join(out)
+
 def applyRule(word, rule, categories):
     """Apply a single rule to a word.
 
@@ -133,109 +694,996 @@ Arguments:
     word       : string
 Returns the output word.
 
-Exception may be an empty string."""
+Exception may be an empty string. To apply the same rule to many words,
+compile it once into a CompiledRule instead."""
 
-    target, replacement, environment, exception = rule
-    try:
-        envmtRE, envBefRE, tgtRE, envAftRE, tgtIndex = ruleToRegex(target, environment, categories)
-    except SCAError as e:
-        raise SCAError('Bad sound change rule: "' + "/".join(rule if exception else rule[0:3]) + '" (environment must contain exactly one underscore)') from e
-    if exception:
+    return CompiledRule(rule, categories).apply(word)
+
+class RuleTransducer:
+    """A sound change rule whose environment, target and exception all have
+a fixed length, compiled into a deterministic finite-state transducer:
+applying it is one linear scan over the word, without any regular
+expressions and without backtracking. Made by CompiledRule.transducer().
+
+Arguments:
+    rule      : CompiledRule
+    before, target, after : lists of character sets of the environment
+        before the target, the target and the environment after it, as
+        returned by ruleExToSets()
+    exception : tuple (before, after) of lists of character sets, or None
+
+The automaton reads the word as it is being changed and is in an
+accepting state wherever the whole environment ends. Its states are the
+sets of environment positions the last characters match (as in the
+shift-and algorithm); only the reachable ones are built, with one
+transition per character of the rule and one for all other characters."""
+
+    def __init__(self, rule, before, target, after, exception=None):
+        self.rule = rule
+        self.befWidth, self.tgtWidth, self.aftWidth = len(before), len(target), len(after)
+        self.exception = exception
+        self.isEpen = rule.isEpen
+        pattern = before + target + after
+        width = len(pattern)
+        masks = {} # {character: set of positions it matches as a bit mask}
+        for index, chars in enumerate(pattern):
+            for char in chars:
+                masks[char] = masks.get(char, 0) | 1 << index
+        states = {0: 0} # {bit mask: state}
+        order = [0]
+        self.transitions = [] # per state, {character: next state}; other characters lead to state 0
+        for mask in order:
+            row = {}
+            for char, charMask in masks.items():
+                nextMask = ((mask << 1) | 1) & charMask
+                if nextMask not in states:
+                    states[nextMask] = len(order)
+                    order.append(nextMask)
+                row[char] = states[nextMask]
+            self.transitions.append(row)
+        self.accepting = [not width or bool(mask >> (width - 1) & 1) for mask in order]
+
+    def __repr__(self):
+        return f"<RuleTransducer: {'/'.join(self.rule.rule if self.rule.rule[3] else self.rule.rule[:3])}, {len(self.accepting)} states>"
+
+    def excepted(self, chars, tgtpos):
+        "Return whether the exception matches chars (the current word) with the target at tgtpos."
+        excBefore, excAfter = self.exception
+        start = tgtpos - len(excBefore)
+        end = tgtpos + self.tgtWidth + len(excAfter)
+        if start < 0 or end > len(chars):
+            return False
+        pattern = excBefore + [None] * self.tgtWidth + excAfter # the target is matched already
+        return all(sets is None or chars[start + i] in sets for i, sets in enumerate(pattern))
+
+    def __call__(self, word, counts=None):
+        """Apply the rule to a word, with the same result as rule.apply().
+
+Arguments:
+    word   : string
+    counts : list [matches, exceptions] to add to, as in
+        CompiledRule.apply(). Defaults to None.
+Returns the output word."""
+
+        transitions, accepting = self.transitions, self.accepting
+        befWidth, tgtWidth, aftWidth = self.befWidth, self.tgtWidth, self.aftWidth
+        width = befWidth + tgtWidth + aftWidth
+        rule, categories, exception = self.rule.rule, self.rule.categories, self.exception
+        chars = [] # the characters read so far, as changed by the rule
+        length = len(word)
+        state = 0
+        read = 0
+        mintgt = 1 # where the next target may begin
+        matches = exceptions = 0
+        changed = False
+        while True:
+            if accepting[state]:
+                end = len(chars)
+                tgtpos = end - aftWidth - tgtWidth
+                # the environment has to begin before the end of the current word
+                if tgtpos >= mintgt and tgtpos - befWidth < len(chars) + length - read:
+                    matches += 1
+                    tgtWord = "".join(chars[tgtpos:tgtpos + tgtWidth])
+                    if exception is not None and self.excepted(chars + list(word[read:read + len(exception[1])]), tgtpos):
+                        exceptions += 1
+                        repword = tgtWord
+                    else:
+                        repword = replace(tgtWord, rule, categories)
+                        chars[tgtpos:tgtpos + tgtWidth] = repword
+                        changed = True
+                        # the automaton restarts on the characters a match could still use
+                        state = 0
+                        for char in chars[max(0, len(chars) - width):]:
+                            state = transitions[state].get(char, 0)
+                    mintgt = tgtpos + len(repword) + (1 if self.isEpen else 0)
+                    if mintgt == tgtpos:
+                        mintgt += 1
+                    continue
+            if read >= length:
+                break
+            char = word[read]
+            read += 1
+            chars.append(char)
+            state = transitions[state].get(char, 0)
+        if counts is not None:
+            counts[0] += matches
+            counts[1] += exceptions
+        return "".join(chars) if changed else word
+
+def parseRewrites(rewrites):
+    """Check and convert rewrite rule strings into a list of tuples.
+
+Arguments:
+    rewrites : list of rewrite rule strings ("original|rewrite")
+Returns a list of tuples (original, rewrite)."""
+
+    rews = []
+    for rule in rewrites:
+        if rule.strip() == "":
+            continue
+        if rule.count("|") != 1:
+            raise SCAError(f'Invalid rewrite rule: "{rule}" (must contain exactly one pipe)')
+        rews.append(tuple(rule.split("|")))
+    return rews
+
+def parseCategories(categories, rews=[]):
+    """Rewrite, check and convert category strings into a dict.
+
+Arguments:
+    categories : list of category strings ("A=abc")
+    rews       : list of tuples (original, rewrite). Defaults to []
+Returns a dict {"A": "abc", ...}."""
+
+    cats = {}
+    for cat in categories:
+        cat = rewrite(cat, rews).strip()
+        if cat == "":
+            continue
         try:
-            excptRE, excBefRE, dummy, excAftRE, etgtIndex = ruleToRegex(target, exception, categories)
-        except SCAError as e:
-            raise SCAError('Bad sound change rule: "' + "/".join(rule) + '" (exception must contain exactly one underscore)') from e
-    else:
-        excptRE = None
+            catKey, catContent = cat.split("=")
+        except ValueError as e:
+            raise SCAError(f'Bad category: "{cat}" (must contain excactly one equals sign)')
+        if len(catKey) != 1:
+            raise SCAError(f'Bad category: "{cat}" (category identifier must be exactly one character')
+        cats[catKey] = catContent # "A=abc" -> "A":"abc"
+    return cats
 
-    # tgtpos is the position of the target, pos is the one of the environment
-    tgtpos = 1
-    pos = 0
-    isEpen = not (tgtRE or envBefRE) # if rule is epenthesis before something
-    while pos < len(word):
-        oldWord = word
-        envMatch = re.match(envmtRE, word[pos:])
-        if envMatch:
-            # find out about the environment
-            envMatchEnd = envMatch.end()
-            envMatchedWord = envMatch.string[:envMatchEnd]
-
-            # then about the target
-            tgtStart, tgtEnd = envMatch.regs[tgtIndex]
-            tgtWord = envMatchedWord[tgtStart:tgtEnd] # the substring to replace
-            if pos + tgtStart != tgtpos: # if we are not arrived yet
-                printDebug("applyRule", ("pos", pos), ("tgtpos", tgtpos), ("tgtStart", tgtStart))
-                if tgtpos == pos:
-                    tgtpos += 1
-                    pos = 0
-                else:
-                    pos += 1
+def parseRules(rules, rews=[]):
+    """Rewrite, check and convert sound change rule strings into a list of tuples.
+
+Arguments:
+    rules : list of rule strings ("target/replacement/environment/exception")
+    rews  : list of tuples (original, rewrite). Defaults to []
+Returns a list of tuples (target, replacement, environment, exception).
+
+Empty rules and comments (starting with *) are skipped."""
+
+    exRules = []
+    for rule in rules:
+        rule = rewrite(rule, rews).strip()
+        if rule == "" or rule[0] == "*": # empty or comment
+            continue
+        rule = rule.replace("\u2192", "/")
+        if "\n" in rule or "\r" in rule:
+            raise SCAError(f'Bad sound change rule: {rule!r} (must be on one line)')
+        # append a / to all rules that don’t have an exception
+        if rule.count("/") == 2:
+            rule += "/"
+        elif rule.count("/") != 3:
+            raise SCAError(f'Bad sound change rule: "{rule}" (must contain two or three slashes)')
+        exRules.append(rule)
+    # convert rules into a list of tuples
+    return [tuple(rule.split("/")) for rule in exRules] # "A/b/_c/d_" -> ("A","b","_c","d_")
+
+
+ENGINES = ("regex", "fst", "codegen", "verify")
+
+class CompiledRuleSet:
+    """A complete set of categories, rewrites and sound change rules,
+checked and compiled once and reusable for any number of words.
+
+Arguments:
+    categories : list of category strings
+    rules      : list of rule strings
+    rewrites   : list of rewrite rule strings. Defaults to []
+    engine     : how the rules are applied, one of ENGINES:
+        "regex": with regular expressions (CompiledRule.apply)
+        "fst": with finite-state transducers where the rules allow it
+            (see CompiledRule.transducer), else with regular expressions
+        "codegen": like "fst", but the rules without a transducer are
+            applied with Python code generated for each of them (see
+            CompiledRule.source)
+        "verify": like "codegen", but every result of a transducer or
+            generated code is checked against the regular expressions;
+            raises SCAError if they differ
+        Defaults to "regex".
+
+Raises SCAError on invalid categories, rules or rewrites. Compiled rule
+sets are hashable and compare equal if their contents are equal, whatever
+their engine.
+
+Attributes:
+    cats     : dict {"A": "abc", ...}
+    rules    : list of tuples (target, replacement, environment, exception)
+    rews     : list of tuples (original, rewrite)
+    rewriter, unrewriter : Rewriters for the rewrites and their reversal
+    compiled : list of CompiledRule objects
+    skipped  : number of rule applications skipped because the word could
+        not match
+    fusedRules, fusedRuns : number of rules that are applied together with
+        their neighbours in one str.translate(), and of such runs of rules
+    transduced : number of rules applied with a RuleTransducer
+    generated  : number of rules applied with generated code
+"""
+
+    def __init__(self, categories=[], rules=[], rewrites=[], engine="regex"):
+        rews = parseRewrites(rewrites)
+        self.setup(parseCategories(categories, rews), parseRules(rules, rews), rews, engine)
+
+    @classmethod
+    def fromConf(cls, conf, engine="regex"):
+        "Compile the categories, rules and rewrites of an SCAConf object."
+        return cls(conf.categories, conf.rules, conf.rewrites, engine)
+
+    @classmethod
+    def fromParsed(cls, cats, rules, rews=[], engine="regex"):
+        """Compile already converted categories, rules and rewrites.
+
+Arguments:
+    cats   : dict {"A": "abc", ...}
+    rules  : list of tuples (target, replacement, environment, exception)
+    rews   : list of tuples (original, rewrite). Defaults to []
+    engine : as for CompiledRuleSet(). Defaults to "regex"."""
+
+        ruleset = cls.__new__(cls)
+        ruleset.setup(dict(cats), [tuple(rule) for rule in rules], [tuple(rule) for rule in rews], engine)
+        return ruleset
+
+    def setup(self, cats, rules, rews, engine="regex"):
+        self.cats = cats
+        self.rules = rules
+        self.rews = rews
+        self.rewriter = Rewriter(rews)
+        self.unrewriter = Rewriter(rews, reverse=True)
+        self.key = (tuple(cats.items()), tuple(rules), tuple(rews))
+        self.fingerprint = hashlib.sha1(repr(self.key).encode("utf8")).hexdigest()
+        # prefixKeys[k] identifies the categories and the first k rules
+        self.prefixKeys = [hashlib.sha1(repr(self.key[0]).encode("utf8")).hexdigest()]
+        for rule in rules:
+            self.prefixKeys.append(hashlib.sha1((self.prefixKeys[-1] + repr(rule)).encode("utf8")).hexdigest())
+        self.compiled = [CompiledRule(rule, cats) for rule in rules]
+        self.skipped = 0 # rule applications skipped by the character index
+        # runEnds[i] is where the run of rules with a charMap that rule i is in ends
+        self.runEnds = [i for i in range(len(rules))]
+        for i in reversed(range(len(rules))):
+            if self.compiled[i].charMap is not None:
+                self.runEnds[i] = self.runEnds[i + 1] if i + 1 < len(rules) and self.compiled[i + 1].charMap is not None else i + 1
+        runs = [self.runEnds[i] - i for i in range(len(rules))
+                if self.compiled[i].charMap is not None and (i == 0 or self.compiled[i - 1].charMap is None)]
+        self.fusedRules = sum(run for run in runs if run > 1)
+        self.fusedRuns = sum(1 for run in runs if run > 1)
+        self.fusedTables = {} # {(start, stop): translation table}
+        self.setEngine(engine)
+
+    def setEngine(self, engine):
+        "Change how the rules are applied; engine is one of ENGINES, as for CompiledRuleSet()."
+        if engine not in ENGINES:
+            raise SCAError(f'Unknown engine: "{engine}" (must be one of {", ".join(ENGINES)})')
+        self.engine = engine
+        self.transduced = self.generated = 0
+        for rule in self.compiled:
+            fst = rule.fastApply if isinstance(rule.fastApply, RuleTransducer) else None # kept from before
+            rule.fastApply = None
+            if engine == "regex" or rule.charMap is not None: # those are translated anyway
                 continue
-            excApplies = False
-            etgtStart = None
-            etgtEnd = None
-            excMatchedWord = None
-            # find out about the exception, if there is one
-            if exception:
-                for expos in range(len(word)):
-                    excMatch = re.match(excptRE, word[expos:])
-                    if excMatch:
-                        excMatchEnd = excMatch.end()
-                        excMatchedWord = excMatch.string[:excMatchEnd]
-                        # then about the exception target
-                        etgtStart, etgtEnd = excMatch.regs[etgtIndex]
-                        if expos + etgtStart == tgtpos: # if they both match the same thing
-                            excApplies = True
-                            break
-            
-            repword = tgtWord if excApplies else replace(tgtWord, rule, categories)
-            
-            word = word[:pos] + envMatchedWord[:tgtStart] + repword + envMatchedWord[tgtEnd:] + word[pos+envMatchEnd:]
-            printDebug("applyRule", ("pos", pos), ("rule", rule), ("envMatchedWord", envMatchedWord), ("excMatchedWord", excMatchedWord), ("tgtStart", tgtStart), ("tgtEnd", tgtEnd),
-                       ("etgtStart", etgtStart), ("etgtEnd", etgtEnd), ("tgtWord", tgtWord), ("repword", repword), ("excApplies", excApplies), ("word", word), ("oldWord", oldWord))
-            # move behind that which already has been processed
-            tgtpos += len(repword) + (1 if isEpen else 0) # add 1 on epenthesis before something – else we’ll get caught in an endless loop
-        if tgtpos == pos:
-            tgtpos += 1
-            pos = 0
+            rule.fastApply, name = fst or rule.transducer(), "Transducer"
+            if rule.fastApply is not None:
+                self.transduced += 1
+            elif engine != "fst":
+                rule.fastApply, name = rule.generated(), "Generated code"
+                self.generated += 1
+            if rule.fastApply is not None and engine == "verify":
+                rule.fastApply = rule.verified(rule.fastApply, name)
+
+    def __setstate__(self, state):
+        # the compiled rules come without their generated code
+        self.__dict__.update(state)
+        self.setEngine(self.engine)
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledRuleSet) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"<CompiledRuleSet: {len(self.cats)} categories, {len(self.rules)} rules ({self.fusedRules} fused), {len(self.rews)} rewrites>"
+
+    def rewrite(self, word):
+        "Apply the rewrite rules to the word."
+        return self.rewriter(word)
+
+    def unrewrite(self, word):
+        "Apply the rewrite rules reversed to the word."
+        return self.unrewriter(word)
+
+    def transformWord(self, word, cache=None, trace=None, profile=None):
+        """Transform a word according to the compiled rules.
+
+Arguments:
+    word    : tuple (word, gloss)
+    cache   : TransformCache to look the word up in and store it in.
+        Defaults to None.
+    trace   : DerivationTrace to record the derivation of the word in; the
+        cache is then bypassed. Defaults to None.
+    profile : RuleProfile to measure the rules in; the cache is then
+        bypassed. Defaults to None.
+Returns a tuple (inword, outword, gloss)."""
+
+        inw, gloss = word
+        if trace is not None or profile is not None:
+            step = None
+            if trace is not None and trace.traces(inw):
+                step = lambda index, before, after: trace.record(inw, index, self.rules[index], before, after)
+            return inw, self.applyRules(inw, step=step, profile=profile), gloss
+        if cache is not None:
+            outw = cache.lookup(self.fingerprint, inw)
+            if outw is None:
+                outw = self.transformWord((inw, gloss))[1]
+                cache.store(self.fingerprint, inw, outw)
+            return inw, outw, gloss
+        return inw, self.applyRules(inw), gloss
+
+    def applyRules(self, word, start=0, stop=None, step=None, profile=None):
+        """Apply the compiled rules from start to stop to a word.
+
+Arguments:
+    word    : string
+    start   : index of the first rule. Defaults to 0.
+    stop    : index after the last rule. Defaults to None (all rules).
+    step    : function called as step(rule index, before, after) whenever
+        a rule changes the word. Defaults to None.
+    profile : RuleProfile to add the time and counts of each rule to.
+        Defaults to None.
+Returns the output word.
+
+Rules are skipped without matching if the word lacks all characters of
+one of their required sets; the skips are counted in self.skipped. Runs
+of rules that only replace characters (see CompiledRule.charMap) are
+applied in one str.translate(), unless there is a step function."""
+
+        if profile is not None:
+            return self.profileRules(word, profile, start, stop, step)
+        compiled, runEnds = self.compiled, self.runEnds
+        stop = len(compiled) if stop is None else min(stop, len(compiled))
+        chars = set(word)
+        skipped = 0
+        index = start
+        while index < stop:
+            rule = compiled[index]
+            if rule.charMap is not None and step is None:
+                end = min(runEnds[index], stop)
+                # the first character is never a target, see CompiledRule.simpleCharMap
+                newWord = word[:1] + word[1:].translate(self.fusedTable(index, end))
+                if newWord != word:
+                    word = newWord
+                    chars = set(word)
+                index = end
+                continue
+            for required in rule.required:
+                if chars.isdisjoint(required):
+                    skipped += 1
+                    break
+            else:
+                newWord = rule.apply(word) if rule.fastApply is None else rule.fastApply(word)
+                if newWord is not word:
+                    if step is not None and newWord != word:
+                        step(index, word, newWord)
+                    word = newWord
+                    chars = set(word)
+            index += 1
+        self.skipped += skipped
+        return word
+
+    def fusedTable(self, start, stop):
+        "Return a str.translate() table for the rules from start to stop, which all have a charMap, in their order."
+        table = self.fusedTables.get((start, stop))
+        if table is None:
+            charMap = {}
+            for rule in self.compiled[start:stop]:
+                for char, rep in charMap.items():
+                    charMap[char] = rule.charMap.get(rep, rep)
+                for char, rep in rule.charMap.items():
+                    charMap.setdefault(char, rep)
+            table = self.fusedTables[(start, stop)] = str.maketrans(charMap)
+        return table
+
+    def profileRules(self, word, profile, start=0, stop=None, step=None):
+        "Apply the compiled rules like applyRules(), measuring each of them in a RuleProfile."
+        stats = profile.setup(self)
+        chars = set(word)
+        counts = [0, 0]
+        for index in range(*slice(start, stop).indices(len(self.compiled))):
+            rule, stat = self.compiled[index], stats[index]
+            if any(chars.isdisjoint(required) for required in rule.required):
+                stat[2] += 1
+                self.skipped += 1
+                continue
+            counts[0] = counts[1] = 0
+            begin = time.perf_counter()
+            newWord = rule.apply(word, counts) if rule.fastApply is None else rule.fastApply(word, counts)
+            stat[0] += time.perf_counter() - begin
+            stat[1] += 1
+            stat[4] += counts[0]
+            stat[5] += counts[1]
+            if newWord != word:
+                stat[3] += 1
+                if step is not None:
+                    step(index, word, newWord)
+                word = newWord
+                chars = set(word)
+        return word
+
+    def transformWords(self, words, workers=None, chunksize=None, cache=None, checkpoints=None, trace=None, profile=None, batch=False, cancelled=None):
+        """Transform a set of words according to the compiled rules.
+
+Arguments:
+    words     : list of tuples (word, gloss)
+    workers   : number of worker processes. Defaults to None, which
+        transforms the words in this process.
+    chunksize : number of words sent to a worker at a time. Defaults to
+        an even split into four chunks per worker.
+    cache     : TransformCache to look the words up in and store them in.
+        Defaults to None.
+    checkpoints : CheckpointStore to resume the words from and keep their
+        intermediate forms in; the words are then transformed in this
+        process. Defaults to None.
+    trace     : DerivationTrace to record the derivations in. All words
+        are then transformed in this process from the first rule on, without
+        cache or checkpoints. Defaults to None.
+    profile   : RuleProfile to measure the rules in. Like with a trace, all
+        words are then transformed in this process from the first rule on.
+        Defaults to None.
+    batch     : Whether to transform the words with transformBatch(),
+        instead of in worker processes, if NumPy is installed. Defaults to
+        False.
+    cancelled : threading.Event checked before each word transformed in
+        this process; once it is set, no more words are transformed and the
+        result is incomplete. Defaults to None.
+Returns a list of tuples (inword, outword, gloss), in the order of words.
+
+With a cache, every distinct word is transformed only once, and only if
+it is not in the cache already."""
+
+        if cancelled is not None and (cache is None or trace is not None or profile is not None): # else only the missing words
+            words = itertools.takewhile(lambda word: not cancelled.is_set(), words)
+        if trace is not None or profile is not None:
+            return [self.transformWord(word, trace=trace, profile=profile) for word in words]
+        if cache is not None:
+            outws = {}
+            for inw, gloss in words:
+                if inw not in outws:
+                    outws[inw] = cache.lookup(self.fingerprint, inw)
+                else:
+                    cache.hit() # repeated in this batch
+            missing = [(inw, "") for inw, outw in outws.items() if outw is None]
+            for inw, outw, gloss in self.transformWords(missing, workers, chunksize, checkpoints=checkpoints, batch=batch, cancelled=cancelled):
+                outws[inw] = outw
+                cache.store(self.fingerprint, inw, outw)
+            return [(inw, outws[inw], gloss) for inw, gloss in words if outws[inw] is not None]
+        if checkpoints is not None:
+            return checkpoints.transformWords(self, words)
+        if batch and importNumpy() is not None:
+            return transformBatch(self, words)
+        if workers is None or workers <= 1:
+            return [self.transformWord(word) for word in words]
+        words = list(words)
+        if chunksize is None:
+            chunksize = -(-len(words) // (workers * 4)) # ceiling division
+        chunksize = max(chunksize, 1)
+        if len(words) <= chunksize:
+            return [self.transformWord(word) for word in words]
+        chunks = [words[i:i + chunksize] for i in range(0, len(words), chunksize)]
+        # the rule set is sent to each worker once, not with every chunk
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=initWorker, initargs=(self,)) as pool:
+            return [transformed for chunk in pool.map(transformChunk, chunks) for transformed in chunk]
+
+class DerivationTrace:
+    """Records the derivations of words: which rule changed which form into
+which. Pass it as the trace argument of sca(), stream() or
+transformWords(); without one, nothing is recorded.
+
+Arguments:
+    words      : words to record, as they are after rewriting, or None for
+        all words. Defaults to None.
+    rules      : rules to record, as indices into the rule list or as rule
+        strings, or None for all rules. Defaults to None.
+    maxrecords : maximum number of records kept; later ones are only
+        counted. Defaults to 10000.
+
+Attributes:
+    records : list of tuples (inword, rule index, rule, before, after)
+    dropped : number of records beyond maxrecords
+"""
+
+    def __init__(self, words=None, rules=None, maxrecords=10000):
+        self.words = None if words is None else {word.strip() for word in words}
+        self.rules = None if rules is None else set(rules)
+        self.maxrecords = maxrecords
+        self.records = []
+        self.dropped = 0
+
+    def __repr__(self):
+        return f"<DerivationTrace: {len(self.records)} records, {self.dropped} dropped>"
+
+    def traces(self, word):
+        "Whether derivations of the word are recorded."
+        return self.words is None or word.strip() in self.words
+
+    def record(self, inword, index, rule, before, after):
+        "Record that rule number index changed the form before of inword into after."
+        if self.rules is not None and not (index in self.rules or
+                                           "/".join(rule if rule[3] else rule[:3]) in self.rules):
+            return
+        if len(self.records) < self.maxrecords:
+            self.records.append((inword, index, rule, before, after))
         else:
-            pos += 1
-        printDebug("applyRule", ("pos", pos), ("tgtpos", tgtpos))
-    return word
-            
+            self.dropped += 1
+
+    def derivations(self):
+        "Return a dict {inword: [(rule index, rule, before, after), ...]}."
+        derivs = {}
+        for inword, *step in self.records:
+            derivs.setdefault(inword, []).append(tuple(step))
+        return derivs
+
+    def format(self):
+        "Return the derivations as a readable string, one rule per line."
+        lines = []
+        for inword, steps in self.derivations().items():
+            lines.append(f"{inword.strip()} \u2192 {steps[-1][3].strip()}")
+            for index, rule, before, after in steps:
+                ruleStr = "/".join(rule if rule[3] else rule[:3])
+                lines.append(f"    {index + 1:>3}  {ruleStr}: {before.strip()} \u2192 {after.strip()}")
+        if self.dropped:
+            lines.append(f"({self.dropped} more changes not recorded)")
+        return "\n".join(lines)
+
+class RuleProfile:
+    """Statistics on what each rule costs and does. Pass it as the profile
+argument of sca(), stream() or transformWords(); without one, nothing is
+measured. The statistics add up over all calls with the same rule set
+and start over when it changes.
+
+Attributes:
+    rules : list of tuples (target, replacement, environment, exception)
+    stats : list of lists [seconds, words, skipped, changed, matches,
+        exceptions] per rule: the time spent in the rule, the number of
+        words it was matched against and skipped for (because they lack
+        the characters it needs), the number of words it changed, the
+        number of places its environment matched and the number of those
+        its exception matched, too
+"""
+
+    columns = ["seconds", "words", "skipped", "changed", "matches", "exceptions"]
+
+    def __init__(self):
+        self.fingerprint = None
+        self.rules = []
+        self.stats = []
+
+    def __repr__(self):
+        return f"<RuleProfile: {len(self.rules)} rules, {self.seconds():.3f} s>"
+
+    def setup(self, ruleset):
+        "Prepare for measuring a CompiledRuleSet and return the stats."
+        if ruleset.fingerprint != self.fingerprint:
+            self.fingerprint = ruleset.fingerprint
+            self.rules = list(ruleset.rules)
+            self.stats = [[0.0, 0, 0, 0, 0, 0] for rule in self.rules]
+        return self.stats
+
+    def seconds(self):
+        "Return the time spent in all rules."
+        return sum(stat[0] for stat in self.stats)
+
+    def rows(self, sortBy=None, reverse=True):
+        """Return a list of tuples (rule index, rule string, seconds, words,
+skipped, changed, matches, exceptions), in rule order or sorted by one of
+the columns."""
+
+        rows = [(index, "/".join(rule if rule[3] else rule[:3]), *stat)
+                for index, (rule, stat) in enumerate(zip(self.rules, self.stats))]
+        if sortBy is not None:
+            column = self.columns.index(sortBy) + 2
+            rows.sort(key=lambda row: row[column], reverse=reverse)
+        return rows
+
+    def format(self, sortBy="seconds"):
+        "Return the statistics as a readable table, the slowest rule first."
+        lines = [f"{'rule':>5} {'seconds':>9} {'words':>7} {'skipped':>7} {'changed':>7} {'matches':>7} {'exceptions':>10}"]
+        for index, ruleStr, seconds, *counts in self.rows(sortBy):
+            words, skipped, changed, matches, exceptions = counts
+            lines.append(f"{index + 1:>5} {seconds:9.4f} {words:>7} {skipped:>7} {changed:>7} {matches:>7} {exceptions:>10}  {ruleStr}")
+        return "\n".join(lines)
+
+    def clear(self):
+        "Reset all statistics."
+        self.stats = [[0.0, 0, 0, 0, 0, 0] for rule in self.rules]
+
+class TransformCache:
+    """A bounded cache of transformed words, shared by any number of rule
+sets and calls. When it is full, the least recently used words are
+dropped. It can be shared between threads.
+
+Arguments:
+    maxsize : maximum number of words kept. Defaults to 100000.
+
+Attributes:
+    hits   : number of words that did not need to be transformed
+    misses : number of words that did
+"""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict() # {(fingerprint, word): outword}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"<TransformCache: {len(self.entries)}/{self.maxsize} words, {self.hits} hits, {self.misses} misses>"
 
-def transformWord(word, rules, categories):
+    def lookup(self, fingerprint, word):
+        "Return the transformed word for a rule set fingerprint, or None if it is not cached."
+        with self.lock:
+            outw = self.entries.get((fingerprint, word))
+            if outw is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end((fingerprint, word))
+        return outw
+
+    def hit(self):
+        "Count a word that did not need to be transformed without a lookup, e.g. one repeated in a batch."
+        with self.lock:
+            self.hits += 1
+
+    def store(self, fingerprint, word, outword):
+        "Cache the transformed word for a rule set fingerprint."
+        with self.lock:
+            self.entries[(fingerprint, word)] = outword
+            self.entries.move_to_end((fingerprint, word))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        "Empty the cache and reset the counters."
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+class CheckpointStore:
+    """Intermediate forms of words after every interval-th rule, kept so
+that a changed rule set only needs to be applied from the first changed
+rule on. The forms are tied to the categories and the rules before
+them, so forms from a different rule prefix are never reused.
+
+Arguments:
+    interval : keep the forms after every interval-th rule (and after
+        the last one). Defaults to 10.
+    maxforms : maximum number of forms kept; when more are stored, the
+        least recently used checkpoints are dropped. Defaults to 1000000.
+
+Attributes:
+    saved : number of rule applications that were skipped by resuming
+"""
+
+    def __init__(self, interval=10, maxforms=1000000):
+        self.interval = max(interval, 1)
+        self.maxforms = maxforms
+        self.stages = collections.OrderedDict() # {prefix key: {inword: form}}
+        self.numForms = 0
+        self.saved = 0
+
+    def __repr__(self):
+        return f"<CheckpointStore: {len(self.stages)} checkpoints, {self.numForms}/{self.maxforms} forms, {self.saved} rule applications saved>"
+
+    def available(self, ruleset):
+        "Return a list of (number of rules, forms) of the checkpoints of the rule set, latest first."
+        return [(k, self.stages[ruleset.prefixKeys[k]]) for k in range(len(ruleset.compiled), 0, -1)
+                if ruleset.prefixKeys[k] in self.stages]
+
+    def store(self, prefixKey, word, form):
+        "Keep the form of the word after the rule prefix."
+        stage = self.stages.setdefault(prefixKey, {})
+        self.stages.move_to_end(prefixKey)
+        if word not in stage:
+            self.numForms += 1
+        stage[word] = form
+        while self.numForms > self.maxforms and len(self.stages) > 1:
+            key, dropped = self.stages.popitem(last=False)
+            self.numForms -= len(dropped)
+
+    def transformWords(self, ruleset, words):
+        """Transform a set of words with a CompiledRuleSet, resuming each
+word from its latest checkpoint.
+
+Arguments:
+    ruleset : CompiledRuleSet
+    words   : list of tuples (word, gloss)
+Returns a list of tuples (inword, outword, gloss)."""
+
+        compiled, prefixKeys = ruleset.compiled, ruleset.prefixKeys
+        available = self.available(ruleset)
+        for k, stage in reversed(available):
+            self.stages.move_to_end(prefixKeys[k])
+        transformed = []
+        for inw, gloss in words:
+            # resume from the latest checkpoint of the word
+            start, word = next(((k, stage[inw]) for k, stage in available if inw in stage), (0, inw))
+            self.saved += start
+            while start < len(compiled):
+                stop = min(start - start % self.interval + self.interval, len(compiled))
+                word = ruleset.applyRules(word, start, stop)
+                self.store(prefixKeys[stop], inw, word)
+                start = stop
+            transformed.append((inw, word, gloss))
+        return transformed
+
+    def clear(self):
+        "Drop all checkpoints."
+        self.stages.clear()
+        self.numForms = 0
+
+def dataDir():
+    "Return the directory the PythonSCA keeps its data in, next to its files: the pysca session directory and the rule set cache."
+    scaDir = os.path.dirname(os.path.abspath(__file__))
+    if os.path.isfile(scaDir): # if it’s packed
+        # then the WD is in the containing folder
+        scaDir = os.path.dirname(scaDir)
+    return scaDir
+
+engineVersionHash = None
+
+def engineVersion():
+    """Return a string that changes whenever compiled rule sets may change:
+a hash of this file, and the version of Python."""
+    global engineVersionHash
+    if engineVersionHash is None:
+        try:
+            with open(os.path.abspath(__file__), "rb") as scaFile:
+                engineVersionHash = hashlib.sha1(scaFile.read()).hexdigest()
+        except OSError: # if it’s packed
+            engineVersionHash = "unknown"
+    return f"{engineVersionHash}-python{sys.version_info[0]}.{sys.version_info[1]}"
+
+class RulesetCache:
+    """Compiled rule sets kept in files, so that a rule set compiled once is
+loaded instead of compiled again, also by later runs of the SCA. The
+files are keyed by a hash of the categories, rules, rewrites and engine
+as they were given, and of engineVersion(), so a cached rule set is found
+without parsing anything. Only valid rule sets are stored.
+
+Arguments:
+    directory : where the files are kept. Defaults to the pysca-cache
+        directory next to the pysca session directory.
+    maxFiles  : maximum number of files kept; when more are stored, the
+        least recently used ones are deleted. Defaults to 64.
+
+Attributes:
+    hits, misses : number of rule sets loaded from a file and compiled
+
+The files are pickles, so only use a directory no one else can write to."""
+
+    def __init__(self, directory=None, maxFiles=64):
+        self.directory = directory or os.path.join(dataDir(), "pysca-cache")
+        self.maxFiles = maxFiles
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return f"<RulesetCache: {self.directory}, {self.hits} hits, {self.misses} misses>"
+
+    def path(self, categories, rules, rewrites, engine):
+        "Return the path of the file of a rule set."
+        key = repr((list(categories), list(rules), list(rewrites), engine, engineVersion()))
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf8")).hexdigest() + ".pickle")
+
+    def load(self, categories=[], rules=[], rewrites=[], engine="regex"):
+        """Return the CompiledRuleSet of the categories, rules and rewrites,
+from its file if there is one, else compiled and stored. Raises SCAError
+like CompiledRuleSet() if they are invalid."""
+
+        path = self.path(categories, rules, rewrites, engine)
+        try:
+            with open(path, "rb") as cacheFile:
+                data = pickle.load(cacheFile)
+            # the generated code goes first, so that the rules find it
+            for fingerprint, (source, code) in data["code"].items():
+                generatedCode.setdefault(fingerprint, (source, marshal.loads(code)))
+            ruleset = pickle.loads(data["ruleset"])
+            if not isinstance(ruleset, CompiledRuleSet): # e.g. stored by another copy of this module
+                raise TypeError(f"not a CompiledRuleSet: {ruleset!r}")
+        except Exception: # missing, damaged or foreign files, which are compiled again
+            pass
+        else:
+            self.hits += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return ruleset
+        self.misses += 1
+        ruleset = CompiledRuleSet(categories, rules, rewrites, engine)
+        self.store(path, ruleset)
+        return ruleset
+
+    def store(self, path, ruleset):
+        "Write a rule set to its file; a cache that can't be written is no error."
+        fingerprints = [rule.fingerprint() for rule in ruleset.compiled if rule.fastApply is not None]
+        code = {fingerprint: (generatedCode[fingerprint][0], marshal.dumps(generatedCode[fingerprint][1]))
+                for fingerprint in fingerprints if fingerprint in generatedCode}
+        tmpPath = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # a file of its own, since threads of one process may store the same rule set at once
+            tmpFd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with open(tmpFd, "wb") as cacheFile:
+                pickle.dump({"code": code, "ruleset": pickle.dumps(ruleset)}, cacheFile)
+            os.replace(tmpPath, path)
+            self.prune()
+        except OSError:
+            try:
+                if tmpPath is not None:
+                    os.remove(tmpPath)
+            except OSError:
+                pass
+
+    def prune(self):
+        "Delete the least recently used files beyond maxFiles."
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".pickle")]
+        if len(files) > self.maxFiles:
+            files.sort(key=os.path.getmtime)
+            for path in files[:len(files) - self.maxFiles]:
+                os.remove(path)
+
+    def clear(self):
+        "Delete all files of the cache."
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith((".pickle", ".tmp")):
+                    os.remove(os.path.join(self.directory, name))
+
+def transformBatch(ruleset, words):
+    """Transform a set of words according to a CompiledRuleSet, applying
+each run of rules that only replace single characters (those with a
+charMap) to all words at once: the words are encoded as one NumPy array
+of code points, and the run as one lookup table composed of the rules in
+their order. The other rules are applied word by word. Needs NumPy.
+
+Arguments:
+    ruleset : CompiledRuleSet
+    words   : list of tuples (word, gloss)
+Returns a list of tuples (inword, outword, gloss), in the order of words."""
+
+    distinct = list(dict.fromkeys(inw for inw, gloss in words))
+    forms = distinct
+    compiled = ruleset.compiled
+    start = 0
+    while start < len(compiled):
+        stop = start
+        if compiled[start].charMap is not None:
+            while stop < len(compiled) and compiled[stop].charMap is not None:
+                stop += 1
+            forms = applyCharMaps([rule.charMap for rule in compiled[start:stop]], forms)
+        else:
+            while stop < len(compiled) and compiled[stop].charMap is None:
+                stop += 1
+            forms = [ruleset.applyRules(form, start, stop) for form in forms]
+        start = stop
+    outws = dict(zip(distinct, forms))
+    return [(inw, outws[inw], gloss) for inw, gloss in words]
+
+def importNumpy():
+    "Import NumPy when the batch engine is first used, so that everything else starts without it; return it, or None if it is not installed."
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+    return numpy
+
+def applyCharMaps(charMaps, words):
+    """Apply a run of character maps, one after the other, to all words at
+once with NumPy.
+
+Arguments:
+    charMaps : list of dicts {character: replacement character}
+    words    : list of strings
+Returns a list of strings. The first character of each word stays as it
+is, as with CompiledRule.apply()."""
+
+    text = "".join(words)
+    if not text:
+        return words
+    numpy = importNumpy()
+    if numpy is None:
+        raise ImportError("transformBatch needs NumPy")
+    codes = numpy.frombuffer(text.encode("utf-32-le"), dtype=numpy.uint32)
+    lengths = numpy.fromiter((len(word) for word in words), dtype=numpy.int64, count=len(words))
+    firsts = (numpy.cumsum(lengths) - lengths)[lengths > 0]
+    size = max(int(codes.max()), *(ord(char) for charMap in charMaps for item in charMap.items() for char in item)) + 1
+    table = numpy.arange(size, dtype=numpy.uint32)
+    for charMap in charMaps:
+        step = numpy.arange(size, dtype=numpy.uint32)
+        step[[ord(char) for char in charMap]] = [ord(char) for char in charMap.values()]
+        table = step[table] # this map after the ones before
+    mapped = table[codes]
+    mapped[firsts] = codes[firsts]
+    text = mapped.tobytes().decode("utf-32-le")
+    # the maps keep the lengths of the words
+    forms = []
+    pos = 0
+    for word in words:
+        forms.append(text[pos:pos + len(word)])
+        pos += len(word)
+    return forms
+
+workerRuleset = None
+
+def initWorker(ruleset):
+    "Set up a worker process of CompiledRuleSet.transformWords with the rule set."
+    global workerRuleset
+    workerRuleset = ruleset
+
+def transformChunk(words):
+    "Transform a chunk of words in a worker process."
+    return [workerRuleset.transformWord(word) for word in words]
+
+def transformWord(word, rules, categories=None):
     """Transform a word according to the categories and rules.
 
 Arguments:
     categories : dict {"A": "abc", ...}
-    rules      : list of tuples (target, replacement, environment, exception)
+    rules      : list of tuples (target, replacement, environment, exception),
+        or a CompiledRuleSet, in which case categories is ignored
     word       : tuple (word, gloss)
 Returns a tuple (inword, outword, gloss).
 
 Exception and gloss may be empty strings."""
 
-    inw, gloss = word
-    word = inw
-    for rule in rules:
-        word = applyRule(word, rule, categories)
-        printDebug("transformWord", ("inw", inw), ("word", word))
-
-    return inw, word, gloss
+    if not isinstance(rules, CompiledRuleSet):
+        rules = CompiledRuleSet.fromParsed(categories, rules)
+    return rules.transformWord(word)
     
 
-def transformWords(words, rules, categories):
+def transformWords(words, rules, categories=None, workers=None, chunksize=None, cache=None):
     """Transform a set of words according to the categories and rules.
 
 Arguments:
     categories : dict {"A": "abc", ...}
-    rules      : list of tuples (target, replacement, environment, exception)
+    rules      : list of tuples (target, replacement, environment, exception),
+        or a CompiledRuleSet, in which case categories is ignored
     words      : list of tuples (word, gloss)
-Returns a list of tuples (inword, outword, gloss).
+    workers    : number of worker processes. Defaults to None (no
+        parallel processing).
+    chunksize  : number of words sent to a worker at a time. Defaults to
+        None (four chunks per worker).
+    cache      : TransformCache for the results. Defaults to None.
+Returns a list of tuples (inword, outword, gloss), in the order of words.
 
-Exception and gloss may be empty strings."""
+Exception and gloss may be empty strings. The rules are compiled only once
+per call; to reuse them across calls, pass a CompiledRuleSet."""
 
-    return [transformWord(word, rules, categories) for word in words]
+    if not isinstance(rules, CompiledRuleSet):
+        rules = CompiledRuleSet.fromParsed(categories, rules)
+    return rules.transformWords(words, workers, chunksize, cache)
 
 def rewrite(word, rules):
     """Apply the rewrite rules to the word.
@@ -261,12 +1709,124 @@ Returns a string."""
         word = word.replace(rule[1], rule[0])
     return word
 
-def sca(categories, rules, words, outFormat=0, rewrites=[], rewOut=False, debug=False):
+class Rewriter:
+    """Rewrite rules compiled into a function that rewrites a word, like
+rewrite() or, reversed, unrewrite().
+
+Arguments:
+    rules   : list of tuples (original, rewrite)
+    reverse : whether to revert the rewrites. Defaults to False.
+
+Attributes:
+    mode : "translate" if all of them are done by one str.translate(),
+        "regex" if by one substitution with an alternation of the strings
+        to replace, or "sequential" if they are done one after the other.
+
+The rules are done in a single pass only where that gives the same result
+as one after the other: no string to replace may be empty, contain or
+overlap with another, or contain a character that an earlier rule puts
+in; and if an earlier rule deletes, all later strings to replace must be
+single characters, which cannot match across the gap."""
+
+    def __init__(self, rules, reverse=False):
+        self.pairs = [(rew, orig) if reverse else (orig, rew) for orig, rew in rules]
+        self.table = {}
+        self.regex = None
+        self.mode = "sequential"
+        if not self.isSinglePass(self.pairs):
+            return
+        for src, rep in self.pairs:
+            self.table.setdefault(src, rep) # a repeated one finds nothing left
+        if all(len(src) == 1 for src in self.table):
+            self.mode = "translate"
+            self.table = str.maketrans(self.table)
+        else:
+            self.mode = "regex"
+            self.regex = re.compile("|".join(map(re.escape, self.table)))
+
+    @staticmethod
+    def isSinglePass(pairs):
+        "Whether the rules (list of tuples (source, replacement)) can be done in a single pass."
+        sources = [src for src, rep in pairs]
+        if not all(sources):
+            return False
+        for i, (src, rep) in enumerate(pairs):
+            for later in sources[i + 1:]:
+                if not set(rep).isdisjoint(later) or not rep and len(later) > 1:
+                    return False
+        distinct = set(sources)
+        for a in distinct:
+            for b in distinct:
+                if a != b and (b in a or any(a[-k:] == b[:k] for k in range(1, min(len(a), len(b))))):
+                    return False
+        return True
+
+    def __repr__(self):
+        return f"<Rewriter: {len(self.pairs)} rules, {self.mode}>"
+
+    def replacement(self, match):
+        return self.table[match.group()]
+
+    def __call__(self, word):
+        "Return the rewritten word."
+        if self.mode == "translate":
+            return word.translate(self.table)
+        if self.mode == "regex":
+            return self.regex.sub(self.replacement, word)
+        for src, rep in self.pairs:
+            word = word.replace(src, rep)
+        return word
+
+def splitWord(word, rews=[]):
+    """Split a lexicon line into the word, rewritten and padded with spaces
+for the word boundaries, and its gloss.
+
+Arguments:
+    word : word string, including the gloss
+    rews : list of tuples (original, rewrite), or a Rewriter. Defaults
+        to []
+Returns a tuple (word, gloss), e.g. "acy \u2023 asu" -> (" acy ", " \u2023 asu")."""
+
+    part = list(word.partition("\u2023"))
+    if part[1]: part[1] = " " + part[1]
+    rewritten = rews(part[0]) if isinstance(rews, Rewriter) else rewrite(part[0], rews)
+    return " " + rewritten.strip() + " ", part[1] + part[2]
+
+def outputFormatter(outFormat=0, rews=[], rewOut=False):
+    """Return a function that formats a transformed word as an output string.
+
+Arguments:
+    outFormat : format string or preset number, as in sca(). Defaults to 0.
+    rews      : list of tuples (original, rewrite). Defaults to []
+    rewOut    : Whether the rewrite rules should be reverted on the
+        output. Defaults to False.
+The function takes the arguments inword, outword and gloss."""
+
+    unrew = Rewriter(rews, reverse=True)
+
+    # replace outFormat indices with format strings
+    if type(outFormat) is int:
+        outFormat = [
+            "{outw}{gloss}",
+            "{inw} \u2192 {outw}{gloss}",
+            "{outw}{gloss} [{inw}]"
+            ][outFormat]
+
+    def formatOutput(inw, outw, gloss):
+        # revert the rewrites once per word, for the check and the output
+        inw, unrewOut = unrew(inw).strip(), unrew(outw).strip()
+        if not (inw or unrewOut or gloss):
+            return ""
+        return outFormat.format(outw=(unrewOut if rewOut else outw.strip()), inw=inw, gloss=gloss)
+    return formatOutput
+
+def sca(categories, rules, words, outFormat=0, rewrites=[], rewOut=False, debug=False, workers=None, chunksize=None, cache=None, checkpoints=None, trace=None, profile=None, batch=False):
     """Apply the specified sound changes to the words. Basically Mark Rosenfelder's SCA\u00b2.
 
 Arguments:
     categories : list of category strings
-    rules      : list of rule strings
+    rules      : list of rule strings, or a CompiledRuleSet, in which case
+        categories and rewrites are ignored
     words      : list of word strings, including glosses
     outFormat  : format of the output, either:
         - a format string, with
@@ -281,86 +1841,134 @@ Arguments:
     rewrites   : List of rewrite rules. Defaults to ""
     rewOut     : Whether the rewrite rules should be reverted on the
         output. Defaults to False.
-    debug      : Whether to print debug information to stderr. WARNING:
-        VERY extensive. Use with care and with as few words and rules as
-        possible. Defaults to False.
+    debug      : Whether to print the derivations of the words to stderr.
+        Defaults to False.
+    workers    : Number of worker processes to transform the words in.
+        Defaults to None (no parallel processing).
+    chunksize  : Number of words sent to a worker at a time. Defaults to
+        None (four chunks per worker).
+    cache      : TransformCache to reuse the transformed words of earlier
+        calls from. Defaults to None.
+    checkpoints : CheckpointStore to resume the words from after the rules
+        that are unchanged since earlier calls. Defaults to None.
+    trace      : DerivationTrace to record the derivations of the words in,
+        instead of printing them for debug. Defaults to None.
+    profile    : RuleProfile to measure the time and effect of each rule
+        in. Defaults to None.
+    batch      : Whether to apply the rules that only replace characters
+        to all words at once with NumPy, if it is installed; see
+        transformBatch(). Defaults to False.
 Returns a list of output strings according to the output format."""
 
-    global gdebug
-    gdebug = debug
+    printTrace = debug and trace is None
+    if printTrace:
+        trace = DerivationTrace()
+
+    # check and compile rewrites, categories and rules
+    ruleset = rules if isinstance(rules, CompiledRuleSet) else CompiledRuleSet(categories, rules, rewrites)
+    rews = ruleset.rews
 
-    # check and convert rewrites into a list
-    rews = []
-    for rule in rewrites:
-        if rule.strip() == "":
-            continue
-        if rule.count("|") != 1:
-            raise SCAError(f'Invalid rewrite rule: "{rule}" (must contain exactly one pipe)')
-        rews.append(rule.split("|"))
-    
-    def   rew(word, addSpace): return (" " + rewrite(word, rews).strip() + " ") if addSpace else rewrite(word, rews).strip()
-    def unrew(word, ignoreRO): return      unrewrite(word, rews).strip() if (ignoreRO or rewOut) else word.strip()
-    
-    # rewrite, check and convert categories into a dict
-    cats = {}
-    for cat in categories:
-        cat = rew(cat, False)
-        if cat == "":
-            continue
-        try:
-            catKey, catContent = cat.split("=")
-        except ValueError as e:
-            raise SCAError(f'Bad category: "{cat}" (must contain excactly one equals sign)')
-        if len(catKey) != 1:
-            raise SCAError(f'Bad category: "{cat}" (category identifier must be exactly one character')
-        cats[catKey] = catContent # "A=abc" -> "A":"abc"
-    
-    # rewrite, check and convert rules
-    exRules = []
-    for rule in rules:
-        rule = rew(rule, False)
-        if rule == "" or rule[0] == "*": # empty or comment
-            continue
-        rule = rule.replace("\u2192", "/")
-        # append a / to all rules that don’t have an exception
-        if rule.count("/") == 2:
-            rule += "/"
-        elif rule.count("/") != 3:
-            raise SCAError(f'Bad sound change rule: "{rule}" (must contain two or three slashes)')
-        exRules.append(rule)
-    # convert rules into a list of tuples
-    rules = [tuple(rule.split("/")) for rule in exRules] # "A/b/_c/d_" -> ["A","b","_c","d_"]
-    
     # rewrite and convert words
-    gwords = []
-    for word in words:
-        part = list(word.partition("\u2023"))
-        if part[1]: part[1] = " " + part[1]
-        gwords.append((part[0], part[1] + part[2]))
-    # convert words into a list of tuples
-    words = [(rew(word[0], True), word[1]) for word in gwords] # "acy \u2023 asu" -> ["acy"," \u2023 asu"]
+    words = [splitWord(word, ruleset.rewriter) for word in words]
 
     # transform the words according to the sound change rules
-    transformed = transformWords(words, rules, cats)
-    printDebug("sca",("words", words), ("rules", rules), ("categories", cats), ("rews", rews), ("transformed[0]", transformed[0] if transformed else None))
+    transformed = ruleset.transformWords(words, workers, chunksize, cache, checkpoints, trace, profile, batch)
+    if printTrace and trace.records:
+        print(trace.format(), file=sys.stderr)
 
-    # replace outFormat indices with format strings
-    if type(outFormat) is int:
-        outFormat = [
-            "{outw}{gloss}",
-            "{inw} \u2192 {outw}{gloss}",
-            "{outw}{gloss} [{inw}]"
-            ][outFormat]
-        
-    return [(outFormat.format(outw=unrew(outw, False), inw=unrew(inw, True), gloss=gloss) if any([unrew(inw, True), unrew(outw, True), gloss]) else "") for inw, outw, gloss in transformed]
+    formatOutput = outputFormatter(outFormat, rews, rewOut)
+    return [formatOutput(*word) for word in transformed]
+
+def stream(conf, lines, cache=None, trace=None, profile=None, ruleset=None):
+    """Apply the sound changes of an SCA configuration to lexicon lines one
+by one, as they are read.
+
+Arguments:
+    conf  : SCAConf object (its inLex is ignored) or CompiledRuleSet
+    lines : iterable of word strings, including glosses; trailing line
+        breaks are removed
+    cache : TransformCache for the transformed words. Defaults to None.
+    trace : DerivationTrace to record the derivations in. Defaults to None.
+    profile : RuleProfile to measure the rules in. Defaults to None.
+    ruleset : CompiledRuleSet of conf, if it is compiled already. Defaults
+        to None.
+Yields the output strings according to the output format of conf (the
+default format if conf is a CompiledRuleSet).
 
+Only the current line is held in memory, so lines can be a file or any
+other iterable of unbounded length."""
+
+    if isinstance(conf, CompiledRuleSet):
+        ruleset, outFormat, rewOut = conf, 0, False
+    else:
+        ruleset, outFormat, rewOut = ruleset or conf.compile(), conf.outFormat, conf.rewOut
+    formatOutput = outputFormatter(outFormat, ruleset.rews, rewOut)
+    for line in lines:
+        yield formatOutput(*ruleset.transformWord(splitWord(line.rstrip("\r\n"), ruleset.rewriter), cache, trace, profile))
+
+def transformTree(rulesets, words):
+    """Transform a set of words with several rule sets that begin with the
+same rules, e.g. those of the daughter languages of one proto-language.
+Every rule that rule sets share from their beginning on is applied only
+once per word, and its outputs are passed on to the rule sets that go on
+differently, like the branches of a family tree.
+
+Arguments:
+    rulesets : dict {name: CompiledRuleSet}
+    words    : list of word strings, including glosses
+Returns a dict {name: list of tuples (inword, outword, gloss)}, in the
+order of words.
+
+Rule sets only share rules if they have the same categories and rewrites."""
+
+    roots = {}
+    for name, ruleset in rulesets.items():
+        roots.setdefault((tuple(ruleset.rews), ruleset.prefixKeys[0]), []).append((name, ruleset))
+    results = {}
+    for branch in roots.values():
+        split = [splitWord(word, branch[0][1].rewriter) for word in words]
+        outputs = {}
+        transformBranch(branch, 0, {inw: inw for inw, gloss in split}, outputs)
+        for name, ruleset in branch:
+            results[name] = [(inw, outputs[name][inw], gloss) for inw, gloss in split]
+    return results
+
+def transformBranch(branch, start, forms, outputs):
+    """Apply the rules of a branch of transformTree() from start on.
+
+Arguments:
+    branch  : list of tuples (name, CompiledRuleSet) that share their first
+        start rules
+    start   : number of rules already applied
+    forms   : dict {inword: form after the first start rules}
+    outputs : dict {name: {inword: outword}} the outputs are put in"""
+
+    first = branch[0][1]
+    end = min(len(ruleset.compiled) for name, ruleset in branch)
+    stop = start
+    while stop < end and all(ruleset.prefixKeys[stop + 1] == first.prefixKeys[stop + 1] for name, ruleset in branch):
+        stop += 1
+    if stop > start:
+        # each distinct form is transformed once
+        done = {form: first.applyRules(form, start, stop) for form in set(forms.values())}
+        forms = {inw: done[form] for inw, form in forms.items()}
+    # the branches split by their next rule
+    children = {}
+    for name, ruleset in branch:
+        if len(ruleset.compiled) == stop:
+            outputs[name] = forms
+        else:
+            children.setdefault(ruleset.prefixKeys[stop + 1], []).append((name, ruleset))
+    for child in children.values():
+        transformBranch(child, stop, forms, outputs)
 
 def printsca(categories, rules, words, outFormat=0, rewrites=[], rewOut=False, debug=False, file=sys.stdout):
     """Apply the specified sound changes to the words. Basically Mark Rosenfelder's SCA\u00b2.
 
 Arguments:
     categories : list of category strings
-    rules      : list of rule strings
+    rules      : list of rule strings, or a CompiledRuleSet, in which case
+        categories and rewrites are ignored
     words      : list of word strings, including glosses
     outFormat  : format of the output, either:
         - a format string, with
@@ -375,14 +1983,34 @@ Arguments:
     rewrites   : List of rewrite rules. Defaults to []
     rewOut     : Whether the rewrite rules should be reverted on the
         output. Defaults to False.
-    debug      : Whether to print debug information to stderr. WARNING:
-        VERY extensive. Use with care and with as few words and rules as
-        possible. Defaults to False.
+    debug      : Whether to print the derivations of the words to stderr.
+        Defaults to False.
 Prints the output according to the output format."""
     
     print(*sca(categories, rules, words, outFormat, rewrites, rewOut, debug), sep="\n", file=file)
 
 
+def toSC(rewrites, categories, rules):
+    "Transform lists of rewrites, categories and rules to an SC file."
+    return ("\n".join(categories) + "\n\n" +
+            "\n".join(rewrites)   + "\n\n" +
+            "\n".join(rules))
+
+def fromSC(sc):
+    "Parse an SC file into lists of rewrites, categories and rules."
+    rewrites   = []
+    categories = []
+    rules      = []
+    for line in sc.splitlines():
+        if   "=" in line:
+            categories.append(line)
+        elif "/" in line:
+            rules.append(line)
+        elif "|" in line:
+            rewrites.append(line)
+    return rewrites, categories, rules
+
+
 class SCAConf:
     """Class for an SCA configuration. Holds all input fields.
 
@@ -403,9 +2031,8 @@ Attributes:
     rewrites   : List of rewrite rule strings. Defaults to []
     rewOut     : Whether the rewrite rules should be reverted on the
         output. Defaults to False.
-    debug      : Whether to print debug information to stderr. WARNING:
-        VERY extensive. Use with care and with as few words and rules as
-        possible. Defaults to False.
+    debug      : Whether to print the derivations of the words to stderr.
+        Defaults to False.
 """
 
     def __init__(self, categories=[], rules=[], inLex=[], outFormat=0, rewrites=[], rewOut=0, debug=0):
@@ -417,9 +2044,22 @@ Attributes:
         self.rewOut = rewOut
         self.debug = debug
         
-    def sca(self):
-        "Run the SCA and return the output as a list."
-        return sca(self.categories, self.rules, self.inLex, self.outFormat, self.rewrites, self.rewOut, self.debug)
+    def compile(self, engine="regex", cache=None):
+        """Compile the categories, rules and rewrites into a CompiledRuleSet,
+or load it from a RulesetCache if cache is given. Defaults to None."""
+        if cache is not None:
+            return cache.load(self.categories, self.rules, self.rewrites, engine)
+        return CompiledRuleSet.fromConf(self, engine)
+
+    def stream(self, lines, cache=None, trace=None, profile=None):
+        "Run the SCA on lexicon lines lazily and yield the outputs; see stream()."
+        return stream(self, lines, cache, trace, profile)
+
+    def sca(self, workers=None, chunksize=None, cache=None, checkpoints=None, trace=None, profile=None, batch=False):
+        """Run the SCA and return the output as a list. The words can be
+transformed in several worker processes, cached, resumed from
+checkpoints, traced, profiled and batched; see sca() for the arguments."""
+        return sca(self.categories, self.rules, self.inLex, self.outFormat, self.rewrites, self.rewOut, self.debug, workers, chunksize, cache, checkpoints, trace, profile, batch)
     
     def printsca(self, file=sys.stdout):
         "Run the SCA and print the outputs."
@@ -467,5 +2107,136 @@ example = SCAConf(
     rewOut = 1
 )
 
+def main(argv=None):
+    """Command line interface of the PythonSCA. Without arguments, print
+the example. Otherwise, e.g.:
+
+    python -m sca apply rules.sc words.slx -o out.slx --format 1
+
+Lexicon and output default to stdin and stdout; both are read and
+written line by line. To derive several languages from one lexicon,
+sharing the work of the rules their .sc files begin with:
+
+    python -m sca tree es.sc fr.sc proto.sc+it.sc -l latin.slx -o out
+
+where a+b joins the .sc files a and b into one. Returns the exit status."""
+
+    parser = argparse.ArgumentParser(prog="python -m sca", description="Apply sound changes to a lexicon without the GUI.")
+    commands = parser.add_subparsers(dest="command")
+    applyCmd = commands.add_parser("apply", help="apply the rules of an .sc file to a lexicon")
+    applyCmd.add_argument("rules", help="sound change file (.sc) with rewrites, categories and rules")
+    applyCmd.add_argument("lexicon", nargs="?", default="-", help="lexicon file (.slx); - or omitted for stdin")
+    applyCmd.add_argument("-o", "--output", default="-", help="output file; - or omitted for stdout")
+    applyCmd.add_argument("-f", "--format", default="0", help="output format: 0, 1 or 2 for the presets of the SCA\u00b2, or a format string with {inw}, {outw} and {gloss}")
+    applyCmd.add_argument("-r", "--rewrite-output", action="store_true", help="revert the rewrite rules on the output")
+    applyCmd.add_argument("-w", "--workers", type=int, help="transform in this many processes (reads the whole lexicon first)")
+    applyCmd.add_argument("-b", "--batch", action="store_true", help="apply rules that only replace characters to the whole lexicon at once (reads the whole lexicon first; needs NumPy)")
+    applyCmd.add_argument("-p", "--profile", action="store_true", help="print the time and effect of each rule to stderr (disables --workers)")
+    applyCmd.add_argument("-e", "--engine", choices=ENGINES, default="regex", help="apply the rules with regular expressions, with finite-state transducers where possible, also with generated code, or with both, checking that they agree")
+    applyCmd.add_argument("--no-cache", action="store_true", help="compile the rules even if they are in the rule set cache, and don't store them there")
+    treeCmd = commands.add_parser("tree", help="apply several .sc files that begin with the same rules to one lexicon")
+    treeCmd.add_argument("rules", nargs="+", help="sound change file per language; join files with + to build one from several")
+    treeCmd.add_argument("-l", "--lexicon", default="-", help="lexicon file (.slx); - or omitted for stdin")
+    treeCmd.add_argument("-o", "--output", help="directory for one output file per language; omitted for a table on stdout")
+    treeCmd.add_argument("-f", "--format", default="0", help="output format, as for apply")
+    treeCmd.add_argument("-r", "--rewrite-output", action="store_true", help="revert the rewrite rules on the output")
+    treeCmd.add_argument("-e", "--engine", choices=ENGINES, default="regex", help="rule engine, as for apply")
+    treeCmd.add_argument("--no-cache", action="store_true", help="don't use the rule set cache, as for apply")
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        example.printsca()
+        return 0
+
+    def readSC(spec):
+        "Read the rewrites, categories and rules of one or more .sc files joined with +."
+        rewrites, categories, rules = [], [], []
+        for path in spec.split("+"):
+            with open(path, encoding="utf-8-sig") as scFile:
+                for part, lines in zip([rewrites, categories, rules], fromSC(scFile.read())):
+                    part += lines
+        return rewrites, categories, rules
+
+    outFormat = int(args.format) if args.format in ("0", "1", "2") else args.format
+    try:
+        outputFormatter(outFormat)("", "", "x") # check the format before reading anything
+    except (KeyError, IndexError, ValueError, AttributeError, TypeError) as e:
+        parser.error(f"bad format {args.format!r}: {e!r} (use {{inw}}, {{outw}} and {{gloss}})")
+    if args.command == "tree":
+        return mainTree(parser, args, readSC, outFormat)
+
+    try:
+        rewrites, categories, rules = readSC(args.rules)
+        inFile = (io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig") if args.lexicon == "-"
+                  else open(args.lexicon, encoding="utf-8-sig"))
+        outFile = (io.TextIOWrapper(sys.stdout.buffer, encoding="utf8", newline="\n") if args.output == "-"
+                   else open(args.output, "w", encoding="utf8"))
+    except OSError as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    conf = SCAConf(categories, rules, [], outFormat, rewrites, args.rewrite_output)
+    profile = RuleProfile() if args.profile else None
+    try:
+        ruleset = conf.compile(args.engine, None if args.no_cache else RulesetCache())
+        if (args.workers or args.batch) and profile is None:
+            outputs = sca(None, ruleset, inFile.read().splitlines(), outFormat, rewOut=args.rewrite_output, workers=args.workers, batch=args.batch)
+        else:
+            outputs = stream(conf, inFile, profile=profile, ruleset=ruleset)
+        outFile.writelines(output + "\n" for output in outputs)
+        if profile is not None:
+            print(profile.format(), file=sys.stderr)
+    except (SCAError, OSError) as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    finally:
+        if args.lexicon != "-": inFile.close()
+        if args.output != "-": outFile.close()
+        else: outFile.flush()
+    return 0
+
+def mainTree(parser, args, readSC, outFormat):
+    "Run the tree command of main()."
+    names = [os.path.splitext(os.path.basename(spec.split("+")[-1]))[0] for spec in args.rules]
+    if len(set(names)) < len(names):
+        names = args.rules
+    if len(set(names)) < len(names):
+        parser.error("the same sound change file is given twice")
+    # with full paths as names, the file names are made from the whole path
+    fileNames = {name: re.sub(r"[\\/:]+", "_", name).strip("._") + ".slx" for name in names}
+    if args.output and len(set(fileNames.values())) < len(names):
+        parser.error("the output files of the sound change files would have the same names; rename or move them")
+    try:
+        inFile = (io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig") if args.lexicon == "-"
+                  else open(args.lexicon, encoding="utf-8-sig"))
+        with inFile:
+            words = inFile.read().splitlines()
+        rulesets = {}
+        cache = None if args.no_cache else RulesetCache()
+        for name, spec in zip(names, args.rules):
+            rewrites, categories, rules = readSC(spec)
+            rulesets[name] = SCAConf(categories, rules, rewrites=rewrites).compile(args.engine, cache)
+        results = transformTree(rulesets, words)
+    except (SCAError, OSError) as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    outputs = {}
+    for name, transformed in results.items():
+        formatOutput = outputFormatter(outFormat, rulesets[name].rews, args.rewrite_output)
+        outputs[name] = [formatOutput(*word) for word in transformed]
+    if args.output:
+        try:
+            os.makedirs(args.output, exist_ok=True)
+            for name in names:
+                with open(os.path.join(args.output, fileNames[name]), "w", encoding="utf8") as outFile:
+                    outFile.writelines(output + "\n" for output in outputs[name])
+        except OSError as e:
+            parser.exit(1, f"{parser.prog}: error: {e}\n")
+    else:
+        outFile = io.TextIOWrapper(sys.stdout.buffer, encoding="utf8", newline="\n")
+        outFile.write("\t".join(names) + "\n")
+        outFile.writelines("\t".join(row) + "\n" for row in zip(*(outputs[name] for name in names)))
+        outFile.flush()
+    return 0
+
 if __name__ == "__main__":
-    example.printsca()
+    # run the main() of the sca module, so that pickled rule sets always
+    # refer to sca.CompiledRuleSet and not to __main__.CompiledRuleSet
+    import sca
+    sys.exit(sca.main())
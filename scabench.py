@@ -0,0 +1,342 @@
+"""Benchmarks for the PythonSCA with synthetic lexicons and rule sets.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+SCA² (C) 2012 Mark Rosenfelder aka Zompist (markrose@zompist.com)
+Python re-code (C) 2015 Andreas Kübrich aka Schyrsivochter (andreas.kuebrich@kuebrich.de)
+
+Usage:
+    python scabench.py run --words 20000 --rules 300 -o results.json
+    python scabench.py compare old.json new.json
+    python scabench.py verify --rounds 20"""
+
+
+import os, sys, time, json, random, argparse, platform, subprocess, tracemalloc
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import sca
+
+
+def makeLexicon(size, seed=None, conf=sca.example, glossRate=0.1):
+    """Generate a synthetic lexicon from the categories of an SCA configuration.
+
+Arguments:
+    size      : number of words
+    seed      : random seed. Defaults to None.
+    conf      : SCAConf object whose C, V and L categories are used for
+        consonants, vowels and long vowels. Defaults to sca.example.
+    glossRate : fraction of words that get a gloss. Defaults to 0.1.
+Returns a list of word strings, including glosses."""
+
+    rnd = random.Random(seed)
+    cats = sca.parseCategories(conf.categories)
+    cons, vows, longs = cats.get("C", "ptk"), cats.get("V", "aiu"), cats.get("L", "")
+    words = []
+    for n in range(size):
+        word = ""
+        for syl in range(rnd.choice([1, 2, 2, 3, 3, 4])):
+            if rnd.random() < 0.85: word += rnd.choice(cons)
+            word += rnd.choice(longs) if longs and rnd.random() < 0.15 else rnd.choice(vows)
+            if rnd.random() < 0.3: word += rnd.choice(cons)
+        if rnd.random() < glossRate:
+            word += f" ‣ gloss{n}"
+        words.append(word)
+    return words
+
+def makeRules(size, seed=None, conf=sca.example):
+    """Generate a cascade of sound change rules over the categories of an SCA
+configuration, starting with its own rules.
+
+Arguments:
+    size : number of rules
+    seed : random seed. Defaults to None.
+    conf : SCAConf object. Defaults to sca.example.
+Returns a list of rule strings with plain and category substitutions,
+conditional rules, exceptions, gemination (²), metathesis, epenthesis
+and deletion."""
+
+    rnd = random.Random(seed)
+    cats = sca.parseCategories(conf.categories)
+    cons, vows = cats.get("C", "ptk"), cats.get("V", "aiu")
+    catKeys = [key for key in cats if len(cats[key]) > 1]
+    def seg(): return rnd.choice(cons + vows)
+    def env(): return rnd.choice(["_", "V_V", "_#", "#_", "C_", "_C", "V_", f"{seg()}_", f"_{seg()}", "[sm]_V"])
+    kinds = [
+        lambda: f"{seg()}/{seg()}/{env()}",                                             # substitution
+        lambda: "{0}/{1}/{2}".format(*rnd.sample(catKeys, 2), env()),                   # category substitution
+        lambda: f"{seg()}/{seg()}/{env()}/{rnd.choice(['_#', '#_', 'V_'])}",            # exception
+        lambda: f"{rnd.choice(cons)}/{rnd.choice(cons)}²/V_V",                          # gemination
+        lambda: f"{rnd.choice(cons)}{rnd.choice(vows)}/\\\\/{rnd.choice(['_#', 'V_'])}", # metathesis
+        lambda: f"/{rnd.choice(vows)}/{rnd.choice(cons)}_{rnd.choice(cons)}#",          # epenthesis
+        lambda: f"{seg()}//{rnd.choice(['_#', 'V_V', 'C_C'])}",                         # deletion
+    ]
+    rules = list(conf.rules[:size])
+    while len(rules) < size:
+        rules.append(rnd.choice(kinds)())
+    return rules
+
+def makeFuzzRules(size, seed=None, conf=sca.example):
+    """Generate random rules for verify(): those of makeRules(), mixed with
+rules that have optional parts, bracketed choices, word boundaries on both
+sides and longer targets, which the transducers cannot all handle.
+
+Arguments:
+    size : number of rules
+    seed : random seed. Defaults to None.
+    conf : SCAConf object. Defaults to sca.example.
+Returns a list of rule strings; the rules of conf are not included."""
+
+    rnd = random.Random(seed)
+    cats = sca.parseCategories(conf.categories)
+    cons, vows = cats.get("C", "ptk"), cats.get("V", "aiu")
+    catKeys = [key for key in cats if len(cats[key]) > 1]
+    def seg(): return rnd.choice(cons + vows)
+    def choice(): return "[" + "".join(rnd.sample(cons + vows, 2)) + "]"
+    kinds = [
+        lambda: f"{seg()}/{seg()}/_",                                                   # plain replacement
+        lambda: "{0}/{1}/_".format(*rnd.sample(catKeys, 2)),                            # category replacement
+        lambda: f"{seg()}/{seg()}/{rnd.choice(['V', 'C', seg()])}(C)_",                 # optional before
+        lambda: f"{seg()}/{seg()}/_({rnd.choice(['V', 'C', seg()])})#",                 # optional after
+        lambda: f"{choice()}/{seg()}/{rnd.choice(['_', 'V_', '_#', choice() + '_'])}",  # bracketed target
+        lambda: f"{seg()}{seg()}/{seg()}/{rnd.choice(['_', '#_', '_#', 'V_C'])}",       # two characters
+        lambda: f"{seg()}/{seg()}{seg()}/#_#",                                          # whole word
+        lambda: f"/{rnd.choice(vows)}/#_{rnd.choice(['C', seg()])}",                    # initial epenthesis
+        lambda: f"/{rnd.choice(vows)}/({rnd.choice(['C', seg()])})_{seg()}",            # epenthesis after an option
+        lambda: f"{seg()}/{seg()}/_/{rnd.choice(['V_', '_(C)V', '#_'])}",               # exception with options
+    ]
+    plain = makeRules(len(conf.rules) + size, rnd.randrange(2**32), conf)[len(conf.rules):]
+    return [rnd.choice(kinds)() if rnd.random() < 0.5 else rule for rule in plain]
+
+def verify(rounds=10, numWords=200, numRules=100, seed=1, conf=sca.example, numpyBatch=True):
+    """Check that all ways of applying rules give the same results as
+applying each rule with its regular expressions (CompiledRule.apply, as in
+sca.applyRule), on random rules and lexicons.
+
+Each rule is checked on its own with its transducer and its generated code;
+each cascade with the rule sets of every engine, whose applyRules() fuses
+runs of rules into one str.translate(), and with sca.transformBatch if
+NumPy is installed.
+
+Arguments:
+    rounds     : number of random rule sets and lexicons. Defaults to 10.
+    numWords   : size of each lexicon. Defaults to 200.
+    numRules   : size of each rule set. Defaults to 100.
+    seed       : random seed of the first round; each further round adds 1.
+        Defaults to 1.
+    conf       : SCAConf object whose categories and rewrites are used.
+        Defaults to sca.example.
+    numpyBatch : whether to check transformBatch where NumPy is installed.
+        Defaults to True.
+Returns a tuple (checks, mismatches): the number of results compared, and
+a list of dicts {"seed", "engine", "rule", "word", "expected", "result"}."""
+
+    checks = 0
+    mismatches = []
+    for roundSeed in range(seed, seed + rounds):
+        lexicon = makeLexicon(numWords, roundSeed, conf, glossRate=0)
+        rules = makeFuzzRules(numRules, roundSeed, conf)
+        def mismatch(engine, rule, word, expected, result):
+            mismatches.append({"seed": roundSeed, "engine": engine, "rule": rule, "word": word,
+                               "expected": expected, "result": result})
+
+        reference = sca.CompiledRuleSet(conf.categories, rules, conf.rewrites)
+        words = [reference.rewrite(word) for word in lexicon]
+        # the rules on their own, on every form the cascade goes through
+        forms = words
+        for compiled in reference.compiled:
+            ruleText = "/".join(compiled.rule if compiled.rule[3] else compiled.rule[:3])
+            engines = [("fst", compiled.transducer()), ("codegen", compiled.generated())]
+            newForms = []
+            for form in forms:
+                expected = compiled.apply(form)
+                for engine, func in engines:
+                    if func is not None:
+                        checks += 1
+                        result = func(form)
+                        if result != expected:
+                            mismatch(engine, ruleText, form, expected, result)
+                newForms.append(expected)
+            forms = newForms
+        # the whole cascade
+        outputs = dict(zip(words, forms))
+        for engine in [engine for engine in sca.ENGINES if engine != "verify"]:
+            ruleset = sca.CompiledRuleSet(conf.categories, rules, conf.rewrites, engine)
+            for word in words:
+                checks += 1
+                result = ruleset.applyRules(word)
+                if result != outputs[word]:
+                    mismatch(engine, None, word, outputs[word], result)
+        if numpyBatch and sca.importNumpy() is not None:
+            for inw, outw, gloss in sca.transformBatch(reference, [(word, "") for word in words]):
+                checks += 1
+                if outw != outputs[inw]:
+                    mismatch("batch", None, inw, outputs[inw], outw)
+    return checks, mismatches
+
+def printMismatches(checks, mismatches, top=20, file=sys.stdout):
+    "Print the results of verify()."
+    print(f"{checks} results compared, {len(mismatches)} mismatches", file=file)
+    for mm in mismatches[:top]:
+        where = f'rule "{mm["rule"]}"' if mm["rule"] is not None else "all rules"
+        print(f'  seed {mm["seed"]}, {mm["engine"]}, {where}: "{mm["word"]}" → "{mm["result"]}" instead of "{mm["expected"]}"', file=file)
+    if len(mismatches) > top:
+        print(f"  … and {len(mismatches) - top} more", file=file)
+
+def ruleTimes(ruleset, words):
+    """Measure how long each rule takes on its own, applied to the whole
+lexicon in turn.
+
+Arguments:
+    ruleset : sca.CompiledRuleSet
+    words   : list of tuples (word, gloss) as returned by sca.splitWord
+Returns a list of dicts {"index", "rule", "seconds", "changed"}."""
+
+    forms = [word for word, gloss in words]
+    times = []
+    for index, rule in enumerate(ruleset.compiled):
+        start = time.perf_counter()
+        newForms = [rule.apply(form) for form in forms]
+        seconds = time.perf_counter() - start
+        changed = sum(new is not old for new, old in zip(newForms, forms))
+        times.append({"index": index, "rule": "/".join(rule.rule if rule.rule[3] else rule.rule[:3]),
+                      "seconds": seconds, "changed": changed})
+        forms = newForms
+    return times
+
+def gitRevision():
+    "Return the current git commit of the PythonSCA, or None."
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(numWords=20000, numRules=300, seed=1, repeat=3, label=None, top=10):
+    """Run the benchmarks and return the results as a JSON-compatible dict.
+
+Arguments:
+    numWords : size of the synthetic lexicon. Defaults to 20000.
+    numRules : size of the synthetic rule cascade. Defaults to 300.
+    seed     : random seed for lexicon and rules. Defaults to 1.
+    repeat   : how often each timing is taken; the best is reported.
+        Defaults to 3.
+    label    : free text to tell runs apart. Defaults to None.
+    top      : number of slowest rules listed. Defaults to 10.
+"""
+
+    conf = sca.example
+    lexicon = makeLexicon(numWords, seed, conf)
+    rules = makeRules(numRules, seed, conf)
+
+    def best(func):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+        return min(times), result
+
+    compileTime, ruleset = best(lambda: sca.CompiledRuleSet(conf.categories, rules, conf.rewrites))
+    scaTime, outputs = best(lambda: sca.sca(conf.categories, rules, lexicon, 0, conf.rewrites, conf.rewOut))
+    words = [sca.splitWord(word, ruleset.rewriter) for word in lexicon]
+    transformTime, transformed = best(lambda: sca.transformWords(words, ruleset))
+
+    # peak memory is measured separately, since tracing slows everything down
+    tracemalloc.start()
+    sca.sca(conf.categories, rules, lexicon, 0, conf.rewrites, conf.rewOut)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    perRule = ruleTimes(ruleset, words)
+    slowest = sorted(perRule, key=lambda r: r["seconds"], reverse=True)[:top]
+
+    return {
+        "label": label,
+        "revision": gitRevision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"words": numWords, "rules": numRules, "seed": seed, "repeat": repeat},
+        "results": {
+            "compile_seconds": compileTime,
+            "fused_rules": ruleset.fusedRules,
+            "sca_seconds": scaTime,
+            "sca_words_per_second": numWords / scaTime if scaTime else None,
+            "transformWords_seconds": transformTime,
+            "transformWords_words_per_second": numWords / transformTime if transformTime else None,
+            "sca_peak_memory_bytes": peak,
+            "rule_seconds_total": sum(r["seconds"] for r in perRule),
+            "slowest_rules": slowest,
+        },
+        "rule_seconds": [r["seconds"] for r in perRule],
+    }
+
+def printResults(results, file=sys.stdout):
+    "Print the results of run() in a readable form."
+    res = results["results"]
+    print(f"PythonSCA benchmark {results['label'] or ''} (revision {results['revision']}, Python {results['python']})", file=file)
+    print(f"{results['params']['words']} words, {results['params']['rules']} rules", file=file)
+    print(f"  compile:        {res['compile_seconds']:10.4f} s  {res.get('fused_rules', 0):12} rules fused", file=file)
+    print(f"  sca():          {res['sca_seconds']:10.4f} s  {res['sca_words_per_second']:12.0f} words/s", file=file)
+    print(f"  transformWords: {res['transformWords_seconds']:10.4f} s  {res['transformWords_words_per_second']:12.0f} words/s", file=file)
+    print(f"  peak memory:    {res['sca_peak_memory_bytes'] / 2**20:10.2f} MiB", file=file)
+    print("  slowest rules:", file=file)
+    for rule in res["slowest_rules"]:
+        print(f"    {rule['index'] + 1:>5}  {rule['seconds']:8.4f} s  {rule['changed']:>7} changed  {rule['rule']}", file=file)
+
+def compare(old, new, file=sys.stdout):
+    "Print how the results of two runs compare."
+    print(f"{old['label'] or old['revision']} → {new['label'] or new['revision']}", file=file)
+    if old["params"] != new["params"]:
+        print(f"  warning: different parameters {old['params']} and {new['params']}", file=file)
+    for key in ["compile_seconds", "sca_seconds", "transformWords_seconds", "sca_peak_memory_bytes"]:
+        a, b = old["results"][key], new["results"][key]
+        print(f"  {key:<24} {a:14.4f} {b:14.4f}  ×{a / b if b else float('inf'):.2f}", file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="scabench.py", description="Benchmark the PythonSCA.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    runCmd = commands.add_parser("run", help="run the benchmarks")
+    runCmd.add_argument("-n", "--words", type=int, default=20000, help="size of the lexicon")
+    runCmd.add_argument("-r", "--rules", type=int, default=300, help="number of rules")
+    runCmd.add_argument("-s", "--seed", type=int, default=1, help="random seed")
+    runCmd.add_argument("--repeat", type=int, default=3, help="repetitions per timing")
+    runCmd.add_argument("-l", "--label", help="label of this run")
+    runCmd.add_argument("-o", "--output", help="write the results as JSON to this file")
+    cmpCmd = commands.add_parser("compare", help="compare two JSON results")
+    cmpCmd.add_argument("old")
+    cmpCmd.add_argument("new")
+    verCmd = commands.add_parser("verify", help="compare all engines with the regular expressions on random rules")
+    verCmd.add_argument("--rounds", type=int, default=10, help="number of random rule sets and lexicons")
+    verCmd.add_argument("-n", "--words", type=int, default=200, help="size of each lexicon")
+    verCmd.add_argument("-r", "--rules", type=int, default=100, help="size of each rule set")
+    verCmd.add_argument("-s", "--seed", type=int, default=1, help="random seed of the first round")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        results = run(args.words, args.rules, args.seed, args.repeat, args.label)
+        printResults(results)
+        if args.output:
+            with open(args.output, "w", encoding="utf8") as jsonFile:
+                json.dump(results, jsonFile, indent=2)
+    elif args.command == "verify":
+        checks, mismatches = verify(args.rounds, args.words, args.rules, args.seed)
+        printMismatches(checks, mismatches)
+        return 1 if mismatches else 0
+    else:
+        with open(args.old, encoding="utf8") as oldFile, open(args.new, encoding="utf8") as newFile:
+            compare(json.load(oldFile), json.load(newFile))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-#!/usr/bin/python3.6
+#!/usr/bin/python3.7
 
 """Graphical interface for the PythonSCA.
 
@@ -22,47 +22,475 @@ Python re-code (C) 2015-2017 Andreas Kübrich aka Schyrsivochter (andreas.kuebri
 import os, sys
 sys.path.append(os.path.dirname(__file__))
 import sca
-import wx
-import re, json
-
-
-def toSC(rewrites, categories, rules):
-    "Transform lists of rewrites, categories and rules to an SC file."
-    return ("\n".join(categories) + "\n\n" +
-            "\n".join(rewrites)   + "\n\n" +
-            "\n".join(rules))
-
-def fromSC(sc):
-    "Parse an SC file into lists of rewrites, categories and rules."
-    rewrites   = []
-    categories = []
-    rules      = []
-    for line in sc.splitlines():
-        if   "=" in line:
-            categories.append(line)
-        elif "/" in line:
-            rules.append(line)
-        elif "|" in line:
-            rewrites.append(line)
-    return rewrites, categories, rules
+import wx, wx.lib.dialogs
+import re, json, uuid, threading
+
+
+def writeAtomic(path, text):
+    """Write text to a file via a temporary file that is then renamed, so
+that a crash never leaves the file half-written."""
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "w", encoding="utf8") as tmpFile:
+        tmpFile.write(text)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    os.replace(tmpPath, path)
+
+
+class OutputView(wx.ListCtrl):
+    """A list of the output lexicon that only renders the visible lines, so
+that it stays fast with hundreds of thousands of words. Shows the output
+strings in one column or, if split is set, the input, output and gloss
+of each word in three.
+
+Attributes:
+    lines : list of output strings
+    words : list of tuples (inword, outword, gloss), or None if only the
+        output strings are known
+"""
+
+    def __init__(self, parent):
+        wx.ListCtrl.__init__(self, parent, style=wx.LC_REPORT|wx.LC_VIRTUAL)
+        self.lines = []
+        self.words = None
+        self.rews = []
+        self.rewOut = False
+        self.split = False
+        self.setColumns()
+        self.Bind(wx.EVT_CONTEXT_MENU, self.onContextMenu)
+        self.Bind(wx.EVT_KEY_DOWN, self.onKey)
+
+    def isSplit(self):
+        return self.split and self.words is not None
+
+    def setColumns(self):
+        "Show one column for the output strings or three for input, output and gloss."
+        self.DeleteAllColumns()
+        if self.isSplit():
+            for label, width in [("Input", 140), ("Output", 140), ("Gloss", 140)]:
+                self.AppendColumn(label, width=width)
+        else:
+            self.AppendColumn("Output", width=420)
+        self.SetItemCount(len(self.lines))
+        self.Refresh()
+
+    def setOutputs(self, lines, words=None, rews=[], rewOut=False):
+        """Show new outputs.
+
+Arguments:
+    lines  : list of output strings
+    words  : list of tuples (inword, outword, gloss) as returned by
+        sca.CompiledRuleSet.transformWords, or None. Defaults to None.
+    rews   : rewrites to revert on the input, and on the output if
+        rewOut is set. Defaults to [].
+    rewOut : Whether the rewrites are reverted on the output. Defaults
+        to False."""
+        split = self.isSplit()
+        self.lines, self.words, self.rews, self.rewOut = lines, words, rews, rewOut
+        if self.isSplit() != split:
+            self.setColumns()
+        else:
+            self.SetItemCount(len(lines))
+            self.Refresh()
+
+    def patch(self, start, stop, lines, words=None):
+        "Replace the outputs start to stop by new ones."
+        self.lines[start:stop] = lines
+        if self.words is not None:
+            if words is None:
+                self.words = None
+                self.setColumns()
+            else:
+                self.words[start:stop] = words
+        self.SetItemCount(len(self.lines))
+        self.Refresh()
+
+    def OnGetItemText(self, item, col):
+        if not self.isSplit():
+            return self.lines[item]
+        inw, outw, gloss = self.words[item]
+        if col == 0:
+            return sca.unrewrite(inw, self.rews).strip()
+        if col == 1:
+            return (sca.unrewrite(outw, self.rews) if self.rewOut else outw).strip()
+        return gloss.replace("\u2023", "", 1).strip()
+
+    def rowText(self, item):
+        "Return the text of a row, with tabs between the columns."
+        return "\t".join(self.OnGetItemText(item, col) for col in range(self.GetColumnCount()))
+
+    def selected(self):
+        "Return the indices of the selected rows."
+        items = []
+        item = self.GetFirstSelected()
+        while item != -1:
+            items.append(item)
+            item = self.GetNextSelected(item)
+        return items
+
+    def find(self, text):
+        """Select the next row after the focused one that contains text,
+ignoring case, and start over at the top after the last row. Returns
+whether a row was found."""
+        text = text.casefold()
+        if not text or not self.lines:
+            return False
+        first = self.GetFocusedItem() + 1
+        count = len(self.lines)
+        for n in range(count):
+            item = (first + n) % count
+            if text in self.rowText(item).casefold():
+                for old in self.selected():
+                    self.Select(old, False)
+                self.Select(item)
+                self.Focus(item)
+                self.EnsureVisible(item)
+                return True
+        return False
+
+    def copySelection(self):
+        "Copy the selected rows to the clipboard."
+        text = "\n".join(self.rowText(item) for item in self.selected())
+        if text and wx.TheClipboard.Open():
+            wx.TheClipboard.SetData(wx.TextDataObject(text))
+            wx.TheClipboard.Close()
+
+    def selectAll(self):
+        self.SetItemState(-1, wx.LIST_STATE_SELECTED, wx.LIST_STATE_SELECTED)
+
+    def export(self, path):
+        "Write all rows to a file, as they are shown."
+        with open(path, "w", encoding="utf8") as lexFile:
+            lexFile.write("\n".join(self.rowText(item) for item in range(len(self.lines))))
+
+    def askExport(self):
+        dlg = wx.FileDialog(self, wildcard=SCAWin.lexTypes, style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_OK:
+            self.export(dlg.GetPath())
+
+    def onKey(self, event):
+        if event.GetModifiers() == wx.MOD_CONTROL:
+            key = event.GetKeyCode()
+            if key == ord("C"):
+                self.copySelection()
+                return
+            if key == ord("A"):
+                self.selectAll()
+                return
+        event.Skip()
+
+    def onContextMenu(self, event):
+        men = wx.Menu()
+        copy = men.Append(wx.ID_ANY, "Copy")
+        selAll = men.Append(wx.ID_ANY, "Select all")
+        men.AppendSeparator()
+        split = men.AppendCheckItem(wx.ID_ANY, "Input, output and gloss in columns")
+        split.Check(self.split)
+        split.Enable(self.words is not None)
+        export = men.Append(wx.ID_ANY, "Export \u2026")
+        men.Bind(wx.EVT_MENU, lambda e: self.copySelection(), copy)
+        men.Bind(wx.EVT_MENU, lambda e: self.selectAll(), selAll)
+        men.Bind(wx.EVT_MENU, lambda e: self.setSplit(not self.split), split)
+        men.Bind(wx.EVT_MENU, lambda e: self.askExport(), export)
+        self.PopupMenu(men)
+
+    def setSplit(self, split):
+        self.split = split
+        self.setColumns()
+
 
 class SCATab:
     "A tab of the PythonSCA GUI application."
 
     lastLex = ""
     lastSC = ""
+    cache = sca.TransformCache() # shared by all tabs
+    rulesetCache = sca.RulesetCache()
+    chunksize = 200 # words transformed between progress updates
+    liveDelay = 300 # milliseconds after the last edit until live update
+    liveMax = 2000 # more changed lines than this are applied in the background
 
     def applyRules(self):
-        "Apply the rules to the input lexicon."
-        outputs = self.getSCAConf().sca()
-        self.olxTxt.ChangeValue("\n".join(outputs))
+        """Apply the rules to the input lexicon in a worker thread, so that
+the window stays usable. Does nothing while the rules are being applied."""
+        if self.worker is not None:
+            return
+        conf = self.getSCAConf()
+        trace = sca.DerivationTrace() if conf.debug else None
+        profile = sca.RuleProfile() if self.prfChk.GetValue() else None
+        self.cancelled = threading.Event()
+        self.worker = threading.Thread(target=self.applyInBackground, daemon=True,
+                                       args=(conf, trace, profile, self.cancelled))
+        self.prgGau.SetRange(max(len(conf.inLex), 1))
+        self.prgGau.SetValue(0)
+        self.appBtn.SetLabel("Cancel")
+        self.worker.start()
+
+    def cancelApply(self):
+        """Stop applying the rules; the output lexicon stays as it was. The
+tab can apply again at once, even if a rule never comes back from a word:
+the worker thread is then left behind and its results are ignored."""
+        if self.worker is not None:
+            self.cancelled.set()
+            if self.worker.is_alive():
+                self.checkpoints = sca.CheckpointStore() # the old worker may still be using the old one
+            self.worker = None
+            if self.frm:
+                self.appBtn.SetLabel("Apply")
+                self.prgGau.SetValue(0)
+
+    def applyInBackground(self, conf, trace, profile, cancelled):
+        """Transform the words of conf chunk by chunk, checking for
+cancellation before each word, and hand the outputs over to
+finishApply() in the GUI thread. Runs in the worker thread."""
+        worker = threading.current_thread()
+        outputs, words = [], []
+        try:
+            ruleset = conf.compile(cache=self.rulesetCache)
+            for start in range(0, len(conf.inLex), self.chunksize):
+                if cancelled.is_set():
+                    break
+                chunk = self.transform(ruleset, conf, conf.inLex[start:start + self.chunksize], trace, profile, cancelled)
+                outputs += chunk[0]
+                words += chunk[1]
+                wx.CallAfter(self.showProgress, len(outputs), worker)
+        except Exception as e: # the tab must not be left busy
+            wx.CallAfter(self.finishApply, None, error=str(e), worker=worker)
+            return
+        wx.CallAfter(self.finishApply, None if cancelled.is_set() else outputs, trace, profile,
+                     words=words, live=(self.liveKey(conf), ruleset, conf.inLex), worker=worker)
+
+    def transform(self, ruleset, conf, lines, trace=None, profile=None, cancelled=None):
+        """Transform lexicon lines like sca.sca(), with the cache and the
+checkpoints of the tab. Returns a tuple (output strings, list of tuples
+(inword, outword, gloss)), which is incomplete if cancelled (a
+threading.Event) is set meanwhile."""
+        words = [sca.splitWord(line, ruleset.rewriter) for line in lines]
+        words = ruleset.transformWords(words, cache=self.cache, checkpoints=self.checkpoints,
+                                       trace=trace, profile=profile, cancelled=cancelled)
+        formatOutput = sca.outputFormatter(conf.outFormat, ruleset.rews, conf.rewOut)
+        return [formatOutput(*word) for word in words], words
+
+    def showProgress(self, done, worker):
+        "Show how many words the worker thread has transformed."
+        if self.frm and worker is self.worker: # else the window has been closed or the worker cancelled meanwhile
+            self.prgGau.SetValue(done)
+
+    def finishApply(self, outputs, trace=None, profile=None, error=None, words=None, live=None, worker=None):
+        """Show the outputs of the worker thread, unless it was cancelled or
+failed, and remember them for live update (live is a tuple (key, rule
+set, input lines))."""
+        if not self.frm or worker is not self.worker: # a cancelled worker has been replaced or left behind
+            return
+        self.worker = None
+        self.appBtn.SetLabel("Apply")
+        self.prgGau.SetValue(0)
+        if error is not None:
+            wx.MessageBox(error, "Error", wx.OK|wx.ICON_ERROR, self.frm)
+            return
+        if outputs is None:
+            return
+        key, ruleset, lines = self.liveState = live
+        self.setOutput(outputs, words, ruleset.rews, key[4])
+        if trace is not None:
+            self.showDerivations(trace)
+        if profile is not None:
+            self.showProfile(profile)
+
+    def liveKey(self, conf):
+        "Return what the outputs of conf depend on besides the input lexicon."
+        return (tuple(conf.rewrites), tuple(conf.categories), tuple(conf.rules),
+                conf.outFormat, conf.rewOut)
+
+    def onLexiconEdit(self, event):
+        "Update the output shortly after the input lexicon was last edited, if live update is on."
+        if self.livChk.GetValue():
+            self.scheduleLiveUpdate()
+        event.Skip()
+
+    def scheduleLiveUpdate(self):
+        "Call liveUpdate() after liveDelay, unless this is called again before."
+        if self.liveTimer is None:
+            self.liveTimer = wx.CallLater(self.liveDelay, self.liveUpdate)
+        else:
+            self.liveTimer.Start(self.liveDelay)
+
+    def liveUpdate(self):
+        """Transform only the lines of the input lexicon that changed since
+the rules were last applied, and patch their outputs into the output
+lexicon. If the rules or the options changed, or too many lines, apply
+the rules to everything in the background instead."""
+        if not self.frm or not self.livChk.GetValue():
+            return
+        if self.worker is not None:
+            self.scheduleLiveUpdate() # try again when it is done
+            return
+        conf = self.getSCAConf()
+        key = self.liveKey(conf)
+        if self.liveState is None or self.liveState[0] != key:
+            self.applyRules()
+            return
+        key, ruleset, oldLines = self.liveState
+        outputs = self.olxLst.lines
+        newLines = conf.inLex
+        # the changed lines lie between the unchanged ones at the beginning and the end
+        common = min(len(oldLines), len(newLines))
+        start = 0
+        while start < common and oldLines[start] == newLines[start]:
+            start += 1
+        end = 0
+        while end < common - start and oldLines[-1 - end] == newLines[-1 - end]:
+            end += 1
+        changed = newLines[start:len(newLines) - end]
+        if len(changed) > self.liveMax:
+            self.applyRules()
+            return
+        newOutputs, newWords = self.transform(ruleset, conf, changed)
+        if not self.tblChk.GetValue():
+            self.patchOutput(outputs, start, len(oldLines) - end, newOutputs)
+        self.olxLst.patch(start, len(oldLines) - end, newOutputs, newWords)
+        self.dirty = True
+        self.liveState = key, ruleset, newLines
+
+    def patchOutput(self, outputs, start, stop, newOutputs):
+        """Replace the lines start to stop of the output lexicon, which
+shows outputs, with newOutputs, without setting the whole text again."""
+        txt = self.olxTxt
+        if wx.Platform == "__WXMSW__":
+            # the native control counts line breaks and characters beyond the BMP twice
+            newline = 2
+            def length(lines): return sum(len(line.encode("utf-16-le")) // 2 + newline for line in lines)
+        else:
+            newline = 1
+            def length(lines): return sum(len(line) + newline for line in lines)
+        if start == 0 and stop == len(outputs) or txt.GetLastPosition() != length(outputs) - newline:
+            txt.ChangeValue("\n".join(outputs[:start] + newOutputs + outputs[stop:]))
+            return
+        begin = length(outputs[:start])
+        if stop < len(outputs): # the changed lines end before a line break
+            txt.Replace(begin, begin + length(outputs[start:stop]),
+                        "".join(output + "\n" for output in newOutputs))
+        else: # the changed lines are the last ones
+            txt.Replace(begin - newline, txt.GetLastPosition(),
+                        "".join("\n" + output for output in newOutputs))
+
+    def setOutput(self, outputs, words=None, rews=[], rewOut=False):
+        "Show a list of output strings in the output lexicon; see OutputView.setOutputs()."
+        self.olxLst.setOutputs(outputs, words, rews, rewOut)
+        self.dirty = True
+        if not self.tblChk.GetValue():
+            self.olxTxt.ChangeValue("\n".join(outputs))
+
+    def getOutput(self):
+        "Return the list of output strings."
+        return self.olxLst.lines
+
+    def showTable(self, table):
+        "Show the output lexicon as a list (for large lexicons) or as text."
+        self.olxTxt.ChangeValue("" if table else "\n".join(self.olxLst.lines))
+        self.olxTxt.Show(not table)
+        self.olxLst.Show(table)
+        self.olxSrc.Show(table)
+        self.olxPnl.Layout()
+
+    def onChange(self, event):
+        "Mark the tab as changed since it was last saved."
+        if event.GetEventObject() not in (self.olxSrc, self.livChk, self.tblChk, self.prfChk):
+            self.dirty = True
+        event.Skip()
+
+    def sessionData(self, saveOutput=True):
+        """Return the contents of the tab as a dict for the session file, with
+the lexicons as single strings. The output lexicon is left out unless
+saveOutput is set."""
+        conf = self.getSCAConf()
+        data = {
+            "outFormat": conf.outFormat if isinstance(conf.outFormat, int) else 3,
+            "customFormat": conf.outFormat if isinstance(conf.outFormat, str) else "",
+            "rewOut": conf.rewOut,
+            "debug": conf.debug,
+            "rewrites": "\n".join(conf.rewrites),
+            "categories": "\n".join(conf.categories),
+            "rules": "\n".join(conf.rules),
+            "inLex": self.ilxTxt.GetValue().strip(),
+        }
+        if saveOutput:
+            data["outLex"] = "\n".join(self.getOutput())
+        return data
+
+    def setSessionData(self, data):
+        "Set the tab contents to a dict from sessionData() or an old __last.json."
+        def lines(value): return value.splitlines() if isinstance(value, str) else value
+        self.setSCAConf(sca.SCAConf(
+            outFormat = data["outFormat"] if data["outFormat"] != 3 else data["customFormat"],
+            rewOut = data["rewOut"],
+            debug = data["debug"],
+            rewrites = lines(data["rewrites"]),
+            categories = lines(data["categories"]),
+            rules = lines(data["rules"]),
+            inLex = lines(data["inLex"])
+        ))
+        if "outLex" in data:
+            self.setOutput(lines(data["outLex"]))
+
+    def onApplyButton(self, event):
+        "The Apply button cancels while the rules are being applied."
+        if self.worker is None:
+            self.applyRules()
+        else:
+            self.cancelApply()
+
+    def showDerivations(self, trace):
+        "Show the derivations recorded in an sca.DerivationTrace in a window."
+        text = trace.format() or "No rule changed any word."
+        dlg = wx.lib.dialogs.ScrolledMessageDialog(self.frm, text, "Derivations",
+                                                   size=wx.Size(520, 400),
+                                                   style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
+        dlg.Show()
+
+    def showProfile(self, profile):
+        """Show the statistics of an sca.RuleProfile in a table beside the
+window, sortable by clicking on the column headers."""
+        dlg = wx.Dialog(self.frm, title="Rule profile", size=wx.Size(560, 400),
+                        style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
+        lst = wx.ListCtrl(dlg, style=wx.LC_REPORT|wx.LC_HRULES)
+        columns = ["#", "Rule", "Seconds", "Words", "Skipped", "Changed", "Matches", "Exceptions"]
+        for col, label in enumerate(columns):
+            lst.AppendColumn(label, format=(wx.LIST_FORMAT_LEFT if col == 1 else wx.LIST_FORMAT_RIGHT))
+        rows = profile.rows()
+        order = {"col": 0, "reverse": False}
+
+        def fill():
+            lst.DeleteAllItems()
+            for index, ruleStr, seconds, *counts in rows:
+                lst.Append([str(index + 1), ruleStr, f"{seconds:.4f}"] + [str(count) for count in counts])
+
+        def sortBy(event):
+            col = event.GetColumn()
+            # a second click on the same column reverses the order
+            order["reverse"] = not order["reverse"] if col == order["col"] else col >= 2
+            order["col"] = col
+            rows.sort(key=lambda row: row[col], reverse=order["reverse"])
+            fill()
+
+        fill()
+        for col in range(len(columns)):
+            lst.SetColumnWidth(col, wx.LIST_AUTOSIZE_USEHEADER)
+        lst.Bind(wx.EVT_LIST_COL_CLICK, sortBy)
+        dlg.SetSizer(wx.BoxSizer())
+        dlg.Sizer.Add(lst, proportion=1, flag=wx.EXPAND)
+        # place it next to the main window, where the output lexicon is
+        win = self.frm.GetTopLevelParent()
+        x = min(win.GetScreenRect().GetRight(), wx.GetDisplaySize().width - dlg.GetSize().width)
+        dlg.SetPosition(wx.Point(max(x, 0), win.GetScreenPosition().y))
+        dlg.Show()
 
     def saveSC(self, scPath):
         "Save the rewrites, categories and rules to a file."
         rews  = self.rewTxt.GetValue().strip().splitlines()
         cats  = self.catTxt.GetValue().strip().splitlines()
         rules = self.rulTxt.GetValue().strip().splitlines()
-        scContent = toSC(rews, cats, rules)
+        scContent = sca.toSC(rews, cats, rules)
         with open(scPath, mode=("w" if os.path.isfile(scPath) else "x"),
                   encoding="utf8") as scFile:
             scFile.write(scContent)
@@ -81,10 +509,11 @@ class SCATab:
             with open(scPath, encoding="utf8") as scFile:
                 scContent = scFile.read()
             scContent = scContent.replace("\ufeff", "", 1) # get rid of that BOM
-            rews, cats, rules = map("\n".join, fromSC(scContent))
+            rews, cats, rules = map("\n".join, sca.fromSC(scContent))
             self.rewTxt.ChangeValue(rews.strip())
             self.catTxt.ChangeValue(cats.strip())
             self.rulTxt.ChangeValue(rules.strip())
+            self.dirty = True
         return exists
 
     def loadLex(self, lexPath):
@@ -95,6 +524,7 @@ class SCATab:
                 lexContent = lexFile.read()
             lexContent = lexContent.replace("\ufeff", "", 1) # get rid of that BOM
             self.ilxTxt.ChangeValue(lexContent.strip())
+            self.dirty = True
         return exists
 
     def setSCAConf(self, conf):
@@ -146,14 +576,14 @@ class SCATab:
             ([self.ilxLbl, (2, 1)], {"flag": wx.EXPAND}),
             ([self.olxLbl, (2, 2)], {"flag": wx.EXPAND}),
             ([self.ilxTxt, (3, 1)], {"flag": wx.EXPAND, "span": (2, 1)}),
-            ([self.olxTxt, (3, 2)], {"flag": wx.EXPAND, "span": (2, 1)}),
+            ([self.olxPnl, (3, 2)], {"flag": wx.EXPAND, "span": (2, 1)}),
             ([self.appBtn, (4, 0)], {"flag": wx.EXPAND|wx.TOP|wx.BOTTOM|wx.LEFT,
                                      "border": 5})
         ]
         for args, kwargs in szOpts:
             sz.Add(*args, **kwargs)
         for widget in [self.rewTxt, self.catTxt, self.rulTxt,
-                       self.ilxTxt, self.olxTxt]:
+                       self.ilxTxt, self.olxPnl]:
             widget.SetMinSize(wx.Size(140, 224))
 
         # all columns should resize
@@ -191,14 +621,14 @@ class SCATab:
             ([self.catTxt, (1, 2)], {"flag": wx.EXPAND, "span": (3, 1)}),
             ([self.rulTxt, (1, 3)], {"flag": wx.EXPAND, "span": (3, 1)}),
             ([self.ilxTxt, (1, 4)], {"flag": wx.EXPAND, "span": (3, 1)}),
-            ([self.olxTxt, (1, 5)], {"flag": wx.EXPAND, "span": (3, 1)}),
+            ([self.olxPnl, (1, 5)], {"flag": wx.EXPAND, "span": (3, 1)}),
             ([self.appBtn, (3, 0)], {"flag": wx.EXPAND|wx.TOP|wx.BOTTOM|wx.LEFT,
                                      "border": 5})
         ]
         for args, kwargs in szOpts:
             sz.Add(*args, **kwargs)
         for widget in [self.rewTxt, self.catTxt, self.rulTxt,
-                       self.ilxTxt, self.olxTxt]:
+                       self.ilxTxt, self.olxPnl]:
             widget.SetMinSize(wx.Size(140, 224))
 
         # all columns except the first should resize
@@ -245,9 +675,18 @@ small window).
         self.ilxLbl = wx.StaticText(self.frm, label="Input lexicon")
         self.ilxTxt = wx.TextCtrl(self.frm, style=wx.TE_MULTILINE|wx.TE_CHARWRAP)
         self.olxLbl = wx.StaticText(self.frm, label="Output lexicon")
-        self.olxTxt = wx.TextCtrl(self.frm, style = wx.TE_MULTILINE |
+        # the output is shown as text or, for large lexicons, as a list
+        self.olxPnl = wx.Panel(self.frm)
+        self.olxTxt = wx.TextCtrl(self.olxPnl, style = wx.TE_MULTILINE |
                                                        wx.TE_CHARWRAP |
                                                        wx.TE_READONLY )
+        self.olxSrc = wx.SearchCtrl(self.olxPnl, style=wx.TE_PROCESS_ENTER)
+        self.olxSrc.ShowCancelButton(True)
+        self.olxLst = OutputView(self.olxPnl)
+        self.olxPnl.SetSizer(wx.BoxSizer(wx.VERTICAL))
+        self.olxPnl.Sizer.Add(self.olxSrc, flag=wx.EXPAND)
+        self.olxPnl.Sizer.Add(self.olxTxt, proportion=1, flag=wx.EXPAND)
+        self.olxPnl.Sizer.Add(self.olxLst, proportion=1, flag=wx.EXPAND)
 
         self.ofmLbl = wx.StaticText(self.optBox, label="Output format")
         self.ofmRb1 = wx.RadioButton(self.optBox, label="output")
@@ -256,8 +695,11 @@ small window).
         self.ofmRb4 = wx.RadioButton(self.optBox, label="Custom:")
         self.ofmEnt = wx.TextCtrl(self.optBox)
         self.reoChk = wx.CheckBox(self.optBox, label="Rewrite on output")
-        self.debChk = wx.CheckBox(self.optBox, label="Debug")
-        self.debChk.Disable()
+        self.debChk = wx.CheckBox(self.optBox, label="Show derivations")
+        self.prfChk = wx.CheckBox(self.optBox, label="Profile rules")
+        self.livChk = wx.CheckBox(self.optBox, label="Live update")
+        self.tblChk = wx.CheckBox(self.optBox, label="Output as list")
+        self.prgGau = wx.Gauge(self.optBox, style=wx.GA_HORIZONTAL|wx.GA_SMOOTH)
 
         def keyHandler(textw):
             def handleKey(event):
@@ -274,19 +716,71 @@ small window).
             textw.SetFont(edtfont)
             textw.DragAcceptFiles(True)
             textw.Bind(wx.EVT_KEY_DOWN, keyHandler(textw))
-
-        self.frm.Bind(wx.EVT_BUTTON, lambda e: self.applyRules(), self.appBtn)
+        self.olxLst.SetFont(edtfont)
+
+        self.frm.Bind(wx.EVT_BUTTON, self.onApplyButton, self.appBtn)
+        self.ilxTxt.Bind(wx.EVT_TEXT, self.onLexiconEdit)
+        self.livChk.Bind(wx.EVT_CHECKBOX, lambda e: self.liveUpdate())
+        self.tblChk.Bind(wx.EVT_CHECKBOX, lambda e: self.showTable(self.tblChk.GetValue()))
+        self.olxSrc.Bind(wx.EVT_TEXT_ENTER, lambda e: self.olxLst.find(self.olxSrc.GetValue()))
+        self.olxSrc.Bind(wx.EVT_SEARCHCTRL_SEARCH_BTN, lambda e: self.olxLst.find(self.olxSrc.GetValue()))
         # TODO:
         ##self.ilxTxt.Bind(wx.EVT_SCROLLWIN, ...)
         ##self.olxTxt.Bind(wx.EVT_SCROLLWIN, ...)
         # check ‘Custom’ if custom format is changed
-        self.ofmEnt.Bind(wx.EVT_TEXT, lambda e: self.ofmRb4.SetValue(True))
+        def onFormatEdit(event):
+            self.ofmRb4.SetValue(True)
+            event.Skip()
+        self.ofmEnt.Bind(wx.EVT_TEXT, onFormatEdit)
+        # any edit or option change reaches the panel
+        for evt in [wx.EVT_TEXT, wx.EVT_CHECKBOX, wx.EVT_RADIOBUTTON]:
+            self.frm.Bind(evt, self.onChange)
 
+        self.showTable(False)
         self.arrange(compact)
 
-    def __init__(self, master=None, conf=None, compact=True):
+    def ensureBuilt(self):
+        """Build the widgets of a tab restored from the last session and
+load its contents, the first time they are needed."""
+        if self.built:
+            return
+        self.built = True
+        self.build(self.master.isCompact)
+        if self.session is not None:
+            data, dirty = self.session, self.dirty
+            try:
+                if isinstance(data, str): # the path of its tab file
+                    with open(data, encoding="utf8") as tabFile:
+                        data = json.load(tabFile)
+                self.setSessionData(data)
+            except (OSError, ValueError, KeyError): # keep the tab empty and save it anew
+                dirty = True
+            self.dirty = dirty
+            self.session = None
+        self.frm.Layout()
+
+    def __init__(self, master=None, conf=None, compact=True, session=None):
+        """Arguments:
+    master  : SCAWin
+    conf    : sca.SCAConf to fill the tab with. Defaults to None.
+    compact : whether to arrange the widgets compactly. Defaults to True.
+    session : the path of a tab file or a dict from the last session; the
+        widgets are then only built and filled by ensureBuilt(). Defaults
+        to None."""
+        self.master = master
+        self.session = session
+        self.built = session is None
+        self.checkpoints = sca.CheckpointStore() # per tab, for editing rules
+        self.worker = None # the thread applying the rules
+        self.cancelled = None
+        self.liveTimer = None
+        self.liveState = None # (key, rule set, input lines, outputs) of the output lexicon
+        self.tabId = uuid.uuid4().hex[:12] # names the session file of the tab
+        self.dirty = True # changed since the session was last saved
+        self.savedFiles = set() # names of the files this tab was last saved in
         self.frm = wx.Panel(master.notebook, style=wx.CLIP_CHILDREN)
-        self.build(compact)
+        if self.built:
+            self.build(compact)
         if conf is not None:
             self.setSCAConf(conf)
 
@@ -297,6 +791,8 @@ class SCAWin:
     tabs       = []
     closedTabs = []
     isCompact = False
+    saveOutput = True # whether the output lexicons are saved on exit
+    savedOutput = None # whether they were in the last session
 
     scTypes =  "SCA sound change files (*.sc)|*.sc|All files (*.*)|*.*"
 
@@ -307,8 +803,16 @@ class SCAWin:
         return (tabno if tabno > -1 else self.notebook.GetSelection())
 
     def curTab(self):
-        "Return the SCATab object of the current tab."
-        return self.tabs[self.notebook.GetSelection()]
+        "Return the SCATab object of the current tab, which is always built."
+        tab = self.tabs[self.notebook.GetSelection()]
+        tab.ensureBuilt()
+        return tab
+
+    def onPageChanged(self, event):
+        "Event handler for selecting a tab: build it if it was not yet."
+        # after the tab lists are in order again, e.g. when moving tabs
+        wx.CallAfter(lambda: self.tabs and self.curTab())
+        event.Skip()
 
     def askSaveSC(self):
         tab = self.curTab()
@@ -337,7 +841,7 @@ class SCAWin:
                 wildcard=self.lexTypes, style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
         if dlg.ShowModal() == wx.ID_OK:
             lexPath = dlg.GetPath()
-            lexContent = tab.olxTxt.GetValue()
+            lexContent = "\n".join(tab.getOutput())
             with open(lexPath, mode=("w" if os.path.isfile(lexPath) else "x"),
                       encoding="utf8") as lexFile:
                 lexFile.write(lexContent)
@@ -370,9 +874,9 @@ class SCAWin:
             tab.catTxt.Clear()
             tab.rulTxt.Clear()
 
-    def newTab(self, tabtext="New tab"):
-        "Open a new blank tab."
-        tab = SCATab(self, compact=self.isCompact)
+    def newTab(self, tabtext="New tab", session=None):
+        "Open a new blank tab, or one restored from the session (see SCATab)."
+        tab = SCATab(self, compact=self.isCompact, session=session)
         self.tabs.append(tab)
         self.notebook.AddPage(tab.frm, tabtext, select=True)
 
@@ -404,6 +908,7 @@ class SCAWin:
     def cloneTab(self, tabno):
         "Open a new tab with the same contents as tab."
         otab = self.tabs[tabno]
+        otab.ensureBuilt()
         self.newTab(self.notebook.GetPageText(tabno))
         ntab = self.curTab()
         ntab.setSCAConf(otab.getSCAConf())
@@ -454,16 +959,23 @@ class SCAWin:
         men.Bind(wx.EVT_MENU, lambda e: self.moveTabRight(self.tabidx(tabno)), mvrtb)
         return men
 
+    def sessionDir(self):
+        "Return the path of the pysca directory that holds the last session."
+        return sca.dataDir() + "/pysca"
+
     def onClose(self, event):
-        "Event handler for closing the window. Includes saving the configuration, the tabs and their contents to the __last files."
-        scaDir = os.path.dirname(os.path.abspath(__file__))
-        if os.path.isfile(scaDir): # if it’s packed
-            # then the WD is created in the containing folder
-            scaDir = os.path.dirname(scaDir)
-        scaDir += "/pysca"
-        scaF = "{}/{}-{}.sc"
-        slxF = "{}/{}-{}.slx"
+        """Event handler for closing the window. Includes saving the
+configuration, the tabs and their contents to the pysca directory.
+
+Only tabs that changed since they were loaded or last saved are written,
+each into its own compact tab-<id>.json file, indexed by __last.json.
+All files are written to a temporary file first and then renamed."""
+        scaDir = self.sessionDir()
+        scaF = "{}-{}.sc"
+        slxF = "{}-{}.slx"
         jsonPath = f"{scaDir}/__last.json"
+        for tab in self.tabs + [tab for tab, text in self.closedTabs]:
+            tab.cancelApply()
         if not os.path.exists(scaDir):
             os.mkdir(scaDir)
 
@@ -476,41 +988,51 @@ class SCAWin:
         else:
             normalRect = tuple(self.win.GetRect())
 
-        # delete the .sc and .slx files
-        for filename in filter(lambda s: re.match("\\d*-.*\\.s(c|lx)", s), os.listdir(scaDir)):
-            os.remove(f"{scaDir}/{filename}")
-
-        # save each of the tabs in a .sc and a .slx file
+        # save each changed tab in a .json file, and in a .sc and a .slx file for the user
+        keep = set()
         for no, tab in enumerate(self.tabs):
-            tab.saveSC (scaF.format(scaDir, no, self.notebook.GetPageText(no)))
-            tab.saveLex(slxF.format(scaDir, no, self.notebook.GetPageText(no)))
-
-        # save everything in a .json file, too
+            name = self.notebook.GetPageText(no)
+            files = {
+                f"tab-{tab.tabId}.json": lambda: json.dumps(tab.sessionData(self.saveOutput),
+                                                            ensure_ascii=False, separators=(",", ":")),
+                scaF.format(no, name): lambda: sca.toSC(tab.rewTxt.GetValue().strip().splitlines(),
+                                                        tab.catTxt.GetValue().strip().splitlines(),
+                                                        tab.rulTxt.GetValue().strip().splitlines()),
+                slxF.format(no, name): lambda: tab.ilxTxt.GetValue().strip(),
+            }
+            changed = tab.dirty or self.saveOutput != self.savedOutput
+            for filename, content in files.items():
+                # a moved or renamed tab may find another tab’s files under its new names
+                if changed or filename not in tab.savedFiles or not os.path.isfile(f"{scaDir}/{filename}"):
+                    tab.ensureBuilt()
+                    writeAtomic(f"{scaDir}/{filename}", content())
+            keep.update(files)
+            tab.savedFiles = set(files)
+            tab.dirty = False
+
+        # save the window and the list of tabs in the __last.json file
         jso = {
+            "version": 2,
             "rect": normalRect,
             "curTab": (self.notebook.GetSelection() if self.tabs else None),
             "isMaximised": isMaximised,
+            "saveOutput": self.saveOutput,
             "tabs": [
                 {
+                    "id": tab.tabId,
                     "name": self.notebook.GetPageText(no),
-                    "outFormat": conf.outFormat if isinstance(conf.outFormat, int) else 3,
-                    "customFormat": conf.outFormat if isinstance(conf.outFormat, str) else "",
-                    "rewOut": conf.rewOut,
-                    "debug": conf.debug,
-                    "rewrites": conf.rewrites,
-                    "categories": conf.categories,
-                    "rules": conf.rules,
-                    "inLex": conf.inLex,
-                    "outLex": self.tabs[no].olxTxt.GetValue().splitlines(),
-                    "lastSC": self.tabs[no].lastSC,
-                    "lastLex": self.tabs[no].lastLex
+                    "lastSC": tab.lastSC,
+                    "lastLex": tab.lastLex
                 }
-                for no, conf in enumerate(map(lambda t: t.getSCAConf(), self.tabs))
+                for no, tab in enumerate(self.tabs)
             ]
         }
+        writeAtomic(jsonPath, json.dumps(jso, indent=2))
 
-        with open(jsonPath, mode=("w" if os.path.isfile(jsonPath) else "x"), encoding="utf8") as jsonfile:
-            json.dump(jso, jsonfile, indent=2)
+        # delete the files of closed, moved and renamed tabs, only now that __last.json no longer lists them
+        for filename in os.listdir(scaDir):
+            if filename not in keep and re.match("(\\d*-.*\\.s(c|lx)|tab-\\w+\\.json)(\\.tmp)?$", filename):
+                os.remove(f"{scaDir}/{filename}")
         event.Skip()
 
     def onWinMiddleClick(self, event):
@@ -543,7 +1065,8 @@ class SCAWin:
         willCompact = self.win.Size.Width < 910
         if self.isCompact != willCompact:
             for tab in self.tabs:
-                tab.arrange(willCompact)
+                if tab.built: # the others are arranged when built
+                    tab.arrange(willCompact)
             self.isCompact = willCompact
         if self.isCompact:
             self.win.SetMinSize(wx.Size(474, 572))
@@ -556,6 +1079,8 @@ class SCAWin:
         keyEvents = {
             (wx.WXK_F9, wx.MOD_NONE):
                 lambda e: self.curTab().applyRules(),
+            (wx.WXK_ESCAPE, wx.MOD_NONE):
+                lambda e: self.curTab().cancelApply(),
             (ord("T"), wx.MOD_CONTROL):
                 lambda e: self.newTab(),
             (ord("W"), wx.MOD_CONTROL):
@@ -618,6 +1143,10 @@ Do not build any tabs or tab contents; that’s the task of newTab() and, ultima
         self.tabmen.AppendSeparator()
         newtb = self.tabmen.Append(wx.ID_NEW, "New tab")
         rsttb = self.tabmen.Append(wx.ID_ANY, "Restore closed tab")
+        self.tabmen.AppendSeparator()
+        self.outMenuItem = self.tabmen.AppendCheckItem(wx.ID_ANY, "Save output lexicons on exit")
+        self.outMenuItem.Check(self.saveOutput)
+        self.win.Bind(wx.EVT_MENU, lambda e: setattr(self, "saveOutput", self.outMenuItem.IsChecked()), self.outMenuItem)
         self.win.Bind(wx.EVT_MENU, lambda e: self.newTab(), newtb)
         self.win.Bind(wx.EVT_MENU, lambda e: self.restoreTab(), rsttb)
 
@@ -628,17 +1157,14 @@ Do not build any tabs or tab contents; that’s the task of newTab() and, ultima
 
         self.win.Bind(wx.EVT_CHAR_HOOK, self.onKeyPress)
         self.win.Bind(wx.EVT_CLOSE, self.onClose)
+        self.notebook.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.onPageChanged)
         self.win.Bind(wx.EVT_MIDDLE_UP, self.onWinMiddleClick)
         #~ self.notebook.Bind(wx.EVT_MOUSE_EVENTS, self.onNBClick)
         self.win.Bind(wx.EVT_SIZE, self.onResize)
 
     def loadLast(self):
-        "Load the configuration, the tabs and their contents from the __last files."
-        scaDir = os.path.dirname(os.path.abspath(__file__))
-        if os.path.isfile(scaDir): # if it’s packed
-            # then the WD is looked for in the containing folder
-            scaDir = os.path.dirname(scaDir)
-        scaDir += "/pysca"
+        "Load the configuration, the tabs and their contents from the pysca directory."
+        scaDir = self.sessionDir()
         # load the .json file
         jsonPath = f"{scaDir}/__last.json"
         try:
@@ -648,28 +1174,22 @@ Do not build any tabs or tab contents; that’s the task of newTab() and, ultima
             if "rect" in jso: self.win.SetRect(jso["rect"])
             if jso["isMaximised"]:
                 self.win.Maximize()
-            for tabJSO in jso["tabs"]:
-                # make a new tab
-                self.newTab()
-                no = self.notebook.GetSelection()
-                tab = self.tabs[no]
-                # load the tab options
-                self.notebook.SetPageText(no, tabJSO["name"])
-                tabConf = sca.SCAConf(
-                    outFormat = (tabJSO["outFormat"]
-                                 if tabJSO["outFormat"] != 3
-                                 else tabJSO["customFormat"]),
-                    rewOut = tabJSO["rewOut"],
-                    debug = tabJSO["debug"],
-                    rewrites = tabJSO["rewrites"],
-                    categories = tabJSO["categories"],
-                    rules = tabJSO["rules"],
-                    inLex = tabJSO["inLex"]
-                )
-                tab.setSCAConf(tabConf)
+            self.saveOutput = self.savedOutput = jso.get("saveOutput", True)
+            self.outMenuItem.Check(self.saveOutput)
+            for no, tabJSO in enumerate(jso["tabs"]):
+                # make a placeholder tab that is built when it is selected
+                if "id" in tabJSO:
+                    self.newTab(tabJSO["name"], session=f"{scaDir}/tab-{tabJSO['id']}.json")
+                    tab = self.tabs[-1]
+                    tab.tabId = tabJSO["id"]
+                    tab.dirty = False
+                    # the files it was saved in on closing
+                    tab.savedFiles = {f"tab-{tab.tabId}.json", f"{no}-{tabJSO['name']}.sc", f"{no}-{tabJSO['name']}.slx"}
+                else: # saved before there were tab files
+                    self.newTab(tabJSO["name"], session=tabJSO)
+                    tab = self.tabs[-1]
                 tab.lastSC = tabJSO["lastSC"]
                 tab.lastLex = tabJSO["lastLex"]
-                tab.olxTxt.SetValue("\n".join(tabJSO["outLex"]))
             if jso["curTab"] is not None:
                 self.notebook.SetSelection(jso["curTab"])
         except FileNotFoundError as e:
@@ -0,0 +1,336 @@
+"""A local server that keeps compiled rule sets of the PythonSCA in memory,
+for tools that apply sound changes many times with the same few rule sets.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+SCA² (C) 2012 Mark Rosenfelder aka Zompist (markrose@zompist.com)
+Python re-code (C) 2015 Andreas Kübrich aka Schyrsivochter (andreas.kuebrich@kuebrich.de)
+
+Usage:
+    python scaserver.py --port 8765
+    python scaserver.py --socket /tmp/sca.sock
+
+The protocol is JSON-RPC 2.0 with one JSON object per line. Methods:
+    compile : params {"categories", "rules", "rewrites", "engine"} (all
+        but rules optional); returns {"ruleset": hash, "rules": number,
+        "cached": whether it was compiled already}
+    apply   : params {"words": list of lexicon lines, and either
+        "ruleset": hash from compile or the params of compile; optionally
+        "format": 0, 1, 2 or a format string, "rewriteOutput": bool and
+        "chunk": number of words per notification}. The outputs are sent
+        in notifications {"method": "output", "params": {"id": id of the
+        request, "start": index of the first word, "outputs": [...]}},
+        then the result {"ruleset", "words", "seconds", "cached"}.
+    stats   : returns the counters of the server
+
+The engines "codegen" and "verify" generate and run Python code from the
+rules, so the server only accepts them if started with --allow-codegen.
+Connections that begin like an HTTP request (e.g. from a web page that
+posts to the port) are closed without an answer."""
+
+
+import os, re, sys, json, time, socket, asyncio, hashlib, argparse, collections
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import sca
+
+
+# JSON-RPC error codes
+PARSE_ERROR, INVALID_REQUEST, METHOD_NOT_FOUND, INVALID_PARAMS, SCA_ERROR = -32700, -32600, -32601, -32602, -32000
+
+class RPCError(Exception):
+    "Error sent back as the error of a JSON-RPC response."
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class SCAServer:
+    """Serves the SCA over JSON-RPC, keeping compiled rule sets by the hash
+of their contents.
+
+Arguments:
+    maxRulesets : number of compiled rule sets kept; the least recently
+        used one is dropped first. Defaults to 32.
+    cacheSize   : number of transformed words kept in a TransformCache
+        shared by all requests, or 0 for none. Defaults to 100000.
+    chunksize   : default number of words per output notification.
+        Defaults to 1000.
+    engines     : engines clients may ask for. Defaults to ("regex", "fst").
+"""
+
+    def __init__(self, maxRulesets=32, cacheSize=100000, chunksize=1000, engines=("regex", "fst")):
+        self.engines = engines
+        self.rulesets = collections.OrderedDict() # {hash: CompiledRuleSet}
+        self.maxRulesets = maxRulesets
+        self.cache = sca.TransformCache(cacheSize) if cacheSize else None
+        self.chunksize = chunksize
+        self.started = time.time()
+        self.requests = self.errors = self.connections = 0
+        self.words = 0
+        self.seconds = 0.0 # spent transforming words
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return f"<SCAServer: {len(self.rulesets)} rule sets, {self.requests} requests>"
+
+    @staticmethod
+    def rulesetHash(params):
+        "Return the hash of the categories, rules, rewrites and engine in the params of compile."
+        content = [params.get("categories", []), params.get("rules", []), params.get("rewrites", []), params.get("engine", "regex")]
+        return hashlib.sha1(json.dumps(content, ensure_ascii=False).encode("utf8")).hexdigest()
+
+    async def ruleset(self, params):
+        """Look up or compile the rule set of the params of compile or apply;
+compiling runs in a thread, like transforming. Returns a tuple (hash,
+CompiledRuleSet, whether it was cached)."""
+
+        if "ruleset" in params:
+            key = params["ruleset"]
+            if key not in self.rulesets:
+                raise RPCError(INVALID_PARAMS, f'Unknown rule set: "{key}" (compile it again)')
+        else:
+            if not isinstance(params.get("rules"), list):
+                raise RPCError(INVALID_PARAMS, "Missing rules or ruleset")
+            self.checkRuleset(params)
+            key = self.rulesetHash(params)
+        if key in self.rulesets:
+            self.hits += 1
+            self.rulesets.move_to_end(key)
+            return key, self.rulesets[key], True
+        self.misses += 1
+        try:
+            ruleset = await asyncio.get_running_loop().run_in_executor(
+                None, sca.CompiledRuleSet, params.get("categories", []), params["rules"], params.get("rewrites", []), params.get("engine", "regex"))
+        except Exception as e: # whatever is wrong with the rules must not end the connection
+            raise RPCError(SCA_ERROR, str(e))
+        self.rulesets[key] = ruleset
+        while len(self.rulesets) > self.maxRulesets:
+            self.rulesets.popitem(last=False)
+        return key, ruleset, False
+
+    def checkRuleset(self, params):
+        "Raise RPCError unless the params of compile are lists of one-line strings and an allowed engine."
+        engine = params.get("engine", "regex")
+        if engine not in self.engines:
+            raise RPCError(INVALID_PARAMS, f'Engine not allowed: "{engine}" (must be one of {", ".join(self.engines)})')
+        for part in ("categories", "rules", "rewrites"):
+            lines = params.get(part, [])
+            if not isinstance(lines, list) or not all(isinstance(line, str) and "\n" not in line and "\r" not in line for line in lines):
+                raise RPCError(INVALID_PARAMS, f"{part} must be a list of strings without line breaks")
+
+    def stats(self):
+        "Return the counters of the server as a dict."
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections": self.connections,
+            "words": self.words,
+            "seconds": self.seconds,
+            "wordsPerSecond": self.words / self.seconds if self.seconds else None,
+            "cacheHits": self.hits,
+            "cacheMisses": self.misses,
+            "rulesets": len(self.rulesets),
+            "wordCacheHits": self.cache.hits if self.cache else 0,
+            "wordCacheSize": len(self.cache) if self.cache else 0,
+            "uptime": time.time() - self.started,
+        }
+
+    def transform(self, ruleset, words, outFormat, rewOut):
+        "Transform a chunk of words; run in a thread so that the server stays responsive."
+        start = time.perf_counter()
+        outputs = sca.sca(None, ruleset, words, outFormat, rewOut=rewOut, cache=self.cache)
+        return outputs, time.perf_counter() - start
+
+    async def apply(self, reqId, params, send):
+        "Handle an apply request, sending the outputs chunk by chunk."
+        words = params.get("words")
+        if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+            raise RPCError(INVALID_PARAMS, "words must be a list of strings")
+        outFormat = params.get("format", 0)
+        if not (outFormat in (0, 1, 2) or isinstance(outFormat, str)):
+            raise RPCError(INVALID_PARAMS, "format must be 0, 1, 2 or a format string")
+        try:
+            sca.outputFormatter(outFormat)("", "", "x") # check the format once, before any rule is applied
+        except (KeyError, IndexError, ValueError, AttributeError, TypeError) as e:
+            raise RPCError(INVALID_PARAMS, f'Bad format: "{outFormat}" ({e!r})')
+        chunksize = max(int(params.get("chunk", self.chunksize)), 1)
+        key, ruleset, cached = await self.ruleset(params)
+        loop = asyncio.get_running_loop()
+        seconds = 0.0
+        for start in range(0, len(words), chunksize):
+            try:
+                outputs, spent = await loop.run_in_executor(None, self.transform, ruleset, words[start:start + chunksize], outFormat, bool(params.get("rewriteOutput")))
+            except sca.SCAError as e:
+                raise RPCError(SCA_ERROR, str(e))
+            except Exception as e: # an engine failing on a word must not end the connection either
+                raise RPCError(SCA_ERROR, f"Applying the rules failed: {e!r}")
+            seconds += spent
+            self.words += len(outputs)
+            self.seconds += spent
+            await send({"jsonrpc": "2.0", "method": "output", "params": {"id": reqId, "start": start, "outputs": outputs}})
+        return {"ruleset": key, "words": len(words), "seconds": seconds, "cached": cached}
+
+    async def dispatch(self, request, send):
+        "Handle one JSON-RPC request and return its response, or None for notifications."
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" or not isinstance(request.get("method"), str):
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": INVALID_REQUEST, "message": "Invalid request"}}
+        self.requests += 1
+        reqId, method, params = request.get("id"), request["method"], request.get("params", {})
+        try:
+            if not isinstance(params, dict):
+                raise RPCError(INVALID_PARAMS, "params must be an object")
+            if method == "compile":
+                key, ruleset, cached = await self.ruleset(params)
+                result = {"ruleset": key, "rules": len(ruleset.rules), "cached": cached}
+            elif method == "apply":
+                result = await self.apply(reqId, params, send)
+            elif method == "stats":
+                result = self.stats()
+            else:
+                raise RPCError(METHOD_NOT_FOUND, f'Method not found: "{method}"')
+        except (TypeError, ValueError, AttributeError) as e: # params of the wrong types
+            self.errors += 1
+            return {"jsonrpc": "2.0", "id": reqId, "error": {"code": INVALID_PARAMS, "message": f"Invalid params: {e}"}}
+        except RPCError as e:
+            self.errors += 1
+            return {"jsonrpc": "2.0", "id": reqId, "error": {"code": e.code, "message": str(e)}}
+        if "id" not in request:
+            return None
+        return {"jsonrpc": "2.0", "id": reqId, "result": result}
+
+    async def handle(self, reader, writer):
+        "Serve one connection; its requests are answered in order."
+        self.connections += 1
+
+        async def send(message):
+            writer.write(json.dumps(message, ensure_ascii=False).encode("utf8") + b"\n")
+            await writer.drain()
+
+        try:
+            first = True
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if first and re.match(rb"[A-Z]+ \S+ HTTP/", line): # not for us
+                    break
+                first = False
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    self.errors += 1
+                    await send({"jsonrpc": "2.0", "id": None, "error": {"code": PARSE_ERROR, "message": "Parse error"}})
+                    continue
+                response = await self.dispatch(request, send)
+                if response is not None:
+                    await send(response)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host="127.0.0.1", port=0, ready=None):
+        """Serve until cancelled, on the Unix socket path if given, else on
+host and port (0 for any free port). ready is called with the address
+once the server listens. Defaults to None."""
+
+        limit = 2 ** 26 # a request holds a whole batch of words on one line
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path, limit=limit)
+            address = path
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=limit)
+            address = server.sockets[0].getsockname()[:2]
+        if ready is not None:
+            ready(address)
+        async with server:
+            await server.serve_forever()
+
+class Client:
+    """A blocking client of an SCAServer, for scripts and build tools.
+
+Arguments:
+    address : path of a Unix socket, or tuple (host, port)
+
+Usage:
+    with Client(("127.0.0.1", 8765)) as client:
+        key = client.call("compile", rules=["s/z/V_V"])["ruleset"]
+        outputs = client.call("apply", ruleset=key, words=["casa"])["outputs"]"""
+
+    def __init__(self, address):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.file = self.socket.makefile("rw", encoding="utf8", newline="\n")
+        self.lastId = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def call(self, method, **params):
+        """Call a method of the server and wait for its result. The outputs
+of apply are collected into result["outputs"]. Raises SCAError with the
+message of the server on errors."""
+
+        self.lastId += 1
+        self.file.write(json.dumps({"jsonrpc": "2.0", "id": self.lastId, "method": method, "params": params}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        outputs = []
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise sca.SCAError("The server closed the connection")
+            message = json.loads(line)
+            if message.get("method") == "output":
+                outputs += message["params"]["outputs"]
+            elif message.get("id") == self.lastId:
+                if "error" in message:
+                    raise sca.SCAError(message["error"]["message"])
+                result = message["result"]
+                if method == "apply":
+                    result["outputs"] = outputs
+                return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="scaserver.py", description="Serve the PythonSCA over JSON-RPC on a local socket.")
+    parser.add_argument("-s", "--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--host", default="127.0.0.1", help="TCP host; defaults to localhost only")
+    parser.add_argument("-p", "--port", type=int, default=0, help="TCP port; 0 or omitted for any free port")
+    parser.add_argument("--rulesets", type=int, default=32, help="number of compiled rule sets kept")
+    parser.add_argument("--word-cache", type=int, default=100000, help="number of transformed words kept; 0 for none")
+    parser.add_argument("--allow-codegen", action="store_true", help="let clients use the engines codegen and verify, which run Python code generated from their rules")
+    args = parser.parse_args(argv)
+
+    engines = sca.ENGINES if args.allow_codegen else ("regex", "fst")
+    server = SCAServer(args.rulesets, args.word_cache, engines=engines)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port,
+                                 ready=lambda address: print(f"PythonSCA server listening on {address}", file=sys.stderr, flush=True)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())